@@ -0,0 +1,189 @@
+"""
+Batch processing of several AOIs, sharing one scene search and one clip per
+scene between sites that overlap or sit next to each other
+"""
+
+import os, json, shutil
+import rasterio
+
+from datetime import datetime, timedelta
+from osgeo import ogr
+from rasterio.mask import mask
+from rasterio.warp import transform_geom
+from requests.exceptions import RequestException
+
+from catalog import search_catalog
+from instrument import start_report
+from jobs import JobQueue, run_scene_jobs
+from ndvi import make_results_dirs, plot_ndvi_timeseries, plot_scene, update_ndvi_timeseries_incremental
+from pl_utils import get_client
+from quality import UDM_BLACKFILL
+from settings import PL_AOIS
+
+OVERLAP_TOLERANCE = 0.005 # degrees; AOIs closer than this share clips
+
+def load_aoi_polygons(aois=None, polygons_dir='polygons/'):
+    if aois is None:
+        aois = sorted([fn[:-5] for fn in os.listdir(polygons_dir) if fn.endswith('.json')])
+    polygons = {}
+    for aoi in aois:
+        with open(os.path.join(polygons_dir, aoi + '.json'), 'r') as f:
+            polygons[aoi] = json.load(f)
+    return polygons
+
+def to_geometry(polygon):
+    return ogr.CreateGeometryFromJson(json.dumps(polygon))
+
+def to_polygon(geometry):
+    return json.loads(geometry.ExportToJson())
+
+def group_aois(polygons, tolerance=OVERLAP_TOLERANCE):
+    # Connected groups of AOIs whose polygons, buffered by tolerance, intersect
+    names = sorted(polygons)
+    geometries = {a : to_geometry(polygons[a]).Buffer(tolerance) for a in names}
+    parent = {a : a for a in names}
+
+    def root(a):
+        while parent[a] != a:
+            a = parent[a]
+        return a
+
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            if geometries[a].Intersects(geometries[b]):
+                parent[root(b)] = root(a)
+
+    groups = {}
+    for a in names:
+        groups.setdefault(root(a), []).append(a)
+    return sorted(groups.values())
+
+def plan_batch(polygons, features, tolerance=OVERLAP_TOLERANCE):
+    # One entry per AOI group: the polygon to clip scenes to (the union of
+    # the group's AOIs, or its convex hull if they do not touch), and for
+    # every scene whose footprint meets it, the AOIs that scene covers
+    plan = []
+    for aois in group_aois(polygons, tolerance):
+        union = to_geometry(polygons[aois[0]])
+        for a in aois[1:]:
+            union = union.Union(to_geometry(polygons[a]))
+        if union.GetGeometryName() != 'POLYGON':
+            union = union.ConvexHull()
+
+        scenes = []
+        for feature in features:
+            footprint = to_geometry(feature['geometry'])
+            if footprint.Intersects(union):
+                covered = [a for a in aois if footprint.Intersects(to_geometry(polygons[a]))]
+                if covered:
+                    scenes.append((feature, covered))
+
+        plan.append({'name' : '+'.join(aois), 'aois' : aois, 'polygon' : to_polygon(union), 'scenes' : scenes})
+    return plan
+
+def search_polygon(polygons):
+    # Single search geometry covering every AOI
+    geometries = [to_geometry(p) for p in polygons.values()]
+    union = geometries[0]
+    for geometry in geometries[1:]:
+        union = union.Union(geometry)
+    if union.GetGeometryName() != 'POLYGON':
+        union = union.ConvexHull()
+    return to_polygon(union)
+
+def crop_scene(scene_path, scene_id, aoi_polygon, results_dir):
+    # Shared clips cover the whole group, so each AOI gets its own copy in
+    # its data/ directory with the rasters cropped to the AOI and filled
+    # outside it, as a clip to the AOI alone would be: analytic pixels with
+    # nodata (or 0) and UDM pixels as blackfill. QA, NDVI, the cube and the
+    # timeseries then only see the AOI's pixels. Other files are copied
+    out_dir = results_dir + 'data/' + scene_id
+    if os.path.islink(out_dir):
+        # Linked to the shared clip by runs before scenes were cropped
+        os.remove(out_dir)
+    if os.path.exists(out_dir):
+        return out_dir
+
+    tmp_dir = results_dir + 'data/.' + scene_id
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name in os.listdir(scene_path):
+        filename = os.path.join(scene_path, name)
+        if not name.endswith('.tif'):
+            shutil.copy(filename, tmp_dir)
+            continue
+        with rasterio.open(filename) as src:
+            fill = UDM_BLACKFILL if 'udm' in name else (src.nodata or 0)
+            geometry = transform_geom('EPSG:4326', src.crs, aoi_polygon)
+            data, transform = mask(src, [geometry], crop=True, nodata=fill)
+            profile = src.profile
+        profile.update(height=data.shape[1], width=data.shape[2], transform=transform)
+        with rasterio.open(os.path.join(tmp_dir, name), 'w', **profile) as dst:
+            dst.write(data)
+    os.rename(tmp_dir, out_dir)
+    return out_dir
+
+def run_batch(aois, base_dir, time_window_length=365 / 2, tolerance=OVERLAP_TOLERANCE):
+    report = start_report('batch')
+    polygons = load_aoi_polygons(aois)
+    for aoi in polygons:
+        make_results_dirs(base_dir + aoi + '/')
+
+    datetime_max = datetime.utcnow()
+    datetime_min = datetime.utcnow() - timedelta(days=time_window_length)
+    features = search_catalog('+'.join(sorted(polygons)), search_polygon(polygons), datetime_min, datetime_max)
+    queue = JobQueue()
+
+    for group in plan_batch(polygons, features, tolerance):
+        print("Processing images for sites: " + ', '.join([a.upper() for a in group['aois']]))
+        # Single-AOI groups download straight into the AOI's own directory
+        if len(group['aois']) == 1:
+            data_dir = base_dir + group['aois'][0] + '/'
+        else:
+            data_dir = base_dir + 'shared/' + group['name'] + '/'
+            if not os.path.exists(data_dir + 'data/'):
+                os.makedirs(data_dir + 'data/')
+
+        # AOIs still missing each scene; scenes already clipped for the group
+        # (e.g. by a run over fewer sites) are fanned out without a download.
+        # Clips go through the job queue under the group's own name, so an
+        # interrupted batch resumes its clip jobs and downloads
+        targets = {}
+        for feature, covered in group['scenes']:
+            missing = [a for a in covered if feature['id'] not in os.listdir(base_dir + a + '/data/')]
+            if missing:
+                targets[feature['id']] = (feature, missing)
+        pending = [feature for feature, missing in targets.values() if not os.path.exists(data_dir + 'data/' + feature['id'])]
+
+        print("Downloading {:d} clips for {:d} sites...".format(len(pending), len(group['aois'])))
+        queue_name = 'batch:' + group['name']
+        queue.enqueue(queue_name, pending)
+        run_scene_jobs(queue, queue_name, group['polygon'], data_dir, process=False)
+        for job in queue.failed_jobs(queue_name):
+            print("Failed to download {scene_id} ({state}, {attempts:d} attempts): {error}".format(**job))
+
+        for scene_id, (feature, missing) in sorted(targets.items()):
+            scene_path = data_dir + 'data/' + scene_id
+            if not os.path.exists(scene_path):
+                continue
+            for aoi in missing:
+                results_dir = base_dir + aoi + '/'
+                try:
+                    plot_scene(crop_scene(scene_path, scene_id, polygons[aoi], results_dir), scene_id, polygons[aoi], results_dir)
+                except (RequestException, KeyError, ValueError) as e:
+                    print("Error: " + str(e))
+                    print("Failed to process image acquired on " + feature['properties']['acquired'] + " for " + aoi.upper())
+
+    for aoi in polygons:
+        print("Calculating average NDVI timeseries for site: " + aoi.upper())
+        results_dir = base_dir + aoi + '/'
+        data = update_ndvi_timeseries_incremental('shp/' + aoi + '.shp', results_dir)
+        plot_ndvi_timeseries(data, aoi.upper(), results_dir)
+
+    report.print_summary()
+    report.write(base_dir + 'reports/')
+    get_client().print_metrics()
+
+if __name__ == "__main__":
+    run_batch(PL_AOIS, '/media/rmsare/GALLIUMOS/ndvi/')
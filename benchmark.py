@@ -0,0 +1,306 @@
+"""
+Offline benchmarks of the NDVI processing stages on synthetic PlanetScope-like
+scenes, with throughput, peak memory and comparison against saved baselines
+"""
+
+import os, sys, json, shutil, tempfile, time, tracemalloc
+import argparse
+import numpy as np
+import rasterio
+
+from datetime import datetime, timedelta
+from osgeo import ogr, osr
+from rasterio.windows import Window
+
+from ndvi import *
+from utils import clip_tiff_by_shapefile, load_image
+
+CRS_EPSG = 32611
+ORIGIN = (318000.0, 4166000.0) # UTM 11N, near the HSL site
+RESOLUTION = 3.0
+COEFFICIENTS = {1 : 2.0e-5, 2 : 2.1e-5, 3 : 2.3e-5, 4 : 3.4e-5}
+
+METADATA_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<ps:EarthObservation xmlns:ps="http://schemas.planet.com/ps/v1/planet_product_metadata_geocorrected_level" xmlns:eop="http://earth.esa.int/eop" xmlns:gml="http://www.opengis.net/gml">
+  <gml:metaDataProperty>
+    <ps:EarthObservationMetaData>
+      <eop:identifier>{scene_id}</eop:identifier>
+      <eop:acquisitionParameters>
+        <ps:Acquisition>
+          <ps:acquisitionDateTime>{acquired}</ps:acquisitionDateTime>
+        </ps:Acquisition>
+      </eop:acquisitionParameters>
+    </ps:EarthObservationMetaData>
+  </gml:metaDataProperty>
+  <gml:target>
+    <ps:Footprint>
+      <gml:multiExtentOf>
+        <gml:MultiSurface>
+          <gml:surfaceMembers>
+            <gml:Polygon>
+              <gml:outerBoundaryIs>
+                <gml:LinearRing>
+                  <gml:coordinates>{coordinates}</gml:coordinates>
+                </gml:LinearRing>
+              </gml:outerBoundaryIs>
+            </gml:Polygon>
+          </gml:surfaceMembers>
+        </gml:MultiSurface>
+      </gml:multiExtentOf>
+    </ps:Footprint>
+  </gml:target>
+  <gml:resultOf>
+    <ps:EarthObservationResult>
+{bands}
+    </ps:EarthObservationResult>
+  </gml:resultOf>
+</ps:EarthObservation>
+"""
+
+BAND_TEMPLATE = """      <ps:bandSpecificMetadata>
+        <ps:bandNumber>{band:d}</ps:bandNumber>
+        <ps:radiometricScaleFactor>0.01</ps:radiometricScaleFactor>
+        <ps:reflectanceCoefficient>{coefficient:.6e}</ps:reflectanceCoefficient>
+      </ps:bandSpecificMetadata>"""
+
+def synthetic_bands(rng, height, width, row_off=0, blackfill=0.1):
+    # Smooth vegetation/bare-ground pattern with sensor noise; the right-hand
+    # blackfill fraction of columns is zero, as in clipped scenes
+    rows = (np.arange(row_off, row_off + height) / 97.)[:, np.newaxis]
+    cols = (np.arange(width) / 131.)[np.newaxis, :]
+    vegetation = 0.5 + 0.25 * np.sin(rows) * np.cos(cols) + 0.25 * np.sin(rows * 0.37 + cols * 0.61)
+    noise = rng.normal(0, 60, (4, height, width))
+
+    bands = np.empty((4, height, width), dtype=np.uint16)
+    bands[0] = np.clip(1800 - 600 * vegetation + noise[0], 1, 65535)
+    bands[1] = np.clip(2000 - 400 * vegetation + noise[1], 1, 65535)
+    bands[2] = np.clip(2200 - 1400 * vegetation + noise[2], 1, 65535)
+    bands[3] = np.clip(2500 + 3500 * vegetation + noise[3], 1, 65535)
+    bands[:, :, int(width * (1 - blackfill)):] = 0
+    return bands
+
+def write_synthetic_scene(scene_dir, scene_id, width, height, acquired, seed=0, tiled=False):
+    # <scene>_3B_AnalyticMS_clip.tif, _udm_clip.tif and _metadata_clip.xml
+    # laid out like an extracted clip
+    if not os.path.exists(scene_dir):
+        os.makedirs(scene_dir)
+    rng = np.random.default_rng(seed)
+    transform = rasterio.Affine(RESOLUTION, 0, ORIGIN[0], 0, -RESOLUTION, ORIGIN[1])
+    profile = {
+        'driver' : 'GTiff',
+        'dtype' : 'uint16',
+        'count' : 4,
+        'width' : width,
+        'height' : height,
+        'crs' : 'EPSG:{:d}'.format(CRS_EPSG),
+        'transform' : transform
+    }
+    if tiled:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    tiff_file = os.path.join(scene_dir, scene_id + '_3B_AnalyticMS_clip.tif')
+    udm_profile = dict(profile, dtype='uint8', count=1)
+    with rasterio.open(tiff_file, 'w', **profile) as dst, \
+         rasterio.open(os.path.join(scene_dir, scene_id + '_3B_udm_clip.tif'), 'w', **udm_profile) as udm:
+        for row in range(0, height, 512):
+            window = Window(0, row, width, min(512, height - row))
+            bands = synthetic_bands(rng, int(window.height), width, row)
+            dst.write(bands, window=window)
+            udm.write((bands[0] == 0).astype(np.uint8)[np.newaxis], window=window)
+
+    xmin, ymax = ORIGIN
+    xmax, ymin = xmin + width * RESOLUTION, ymax - height * RESOLUTION
+    coordinates = ' '.join(['{:f},{:f}'.format(x, y) for x, y in [(xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin), (xmin, ymax)]])
+    bands = '\n'.join([BAND_TEMPLATE.format(band=b, coefficient=c) for b, c in sorted(COEFFICIENTS.items())])
+    with open(os.path.join(scene_dir, scene_id + '_3B_AnalyticMS_metadata_clip.xml'), 'w') as f:
+        f.write(METADATA_TEMPLATE.format(scene_id=scene_id, acquired=acquired.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+                                         coordinates=coordinates, bands=bands))
+
+    return tiff_file
+
+def write_synthetic_shapefile(filename, width, height, n_zones=4):
+    # n_zones x n_zones grid of square plots over the central half of the scene
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(CRS_EPSG)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(filename):
+        driver.DeleteDataSource(filename)
+    datasource = driver.CreateDataSource(filename)
+    layer = datasource.CreateLayer('plots', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+
+    x0, y0 = ORIGIN[0] + width * RESOLUTION / 4., ORIGIN[1] - height * RESOLUTION / 4.
+    dx, dy = width * RESOLUTION / 2. / n_zones, height * RESOLUTION / 2. / n_zones
+    for i in range(n_zones):
+        for j in range(n_zones):
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]:
+                ring.AddPoint(x0 + (j + x) * dx, y0 - (i + y) * dy)
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('name', 'plot_{:d}_{:d}'.format(i, j))
+            feature.SetGeometry(polygon)
+            layer.CreateFeature(feature)
+    datasource = None
+
+    return filename
+
+def make_synthetic_dataset(root, n_scenes=8, width=2048, height=2048, tiled=False):
+    # Results directory with n_scenes synthetic scenes in data/ and a plot
+    # shapefile; existing scenes of the same size are reused
+    results_dir = os.path.join(root, 'results') + '/'
+    make_results_dirs(results_dir)
+    start = datetime(2018, 5, 1, 18, 0, 0)
+    for i in range(n_scenes):
+        acquired = start + timedelta(days=3 * i, seconds=i)
+        scene_id = acquired.strftime('%Y%m%d_%H%M%S') + '_{:04x}'.format(0x0f00 + i)
+        scene_dir = results_dir + 'data/' + scene_id
+        if not os.path.exists(scene_dir):
+            write_synthetic_scene(scene_dir, scene_id, width, height, acquired, seed=i, tiled=tiled)
+    shapefile = write_synthetic_shapefile(os.path.join(root, 'plots.shp'), width, height)
+
+    return results_dir, shapefile
+
+def measure(func, args=(), repeat=3):
+    # Best wall time over repeat runs, then one more run under tracemalloc
+    # for the peak of Python and numpy allocations (GDAL's own buffers are
+    # not traced)
+    seconds = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak
+
+def run_benchmarks(results_dir, shapefile, repeat=3, stages=None):
+    scene_dirs = [results_dir + 'data/' + d for d in list_scene_dirs(results_dir + 'data/')]
+    tiff_file, metadata_file = find_scene_files(scene_dirs[0])
+    udm_file = find_udm_file(scene_dirs[0])
+    with rasterio.open(tiff_file) as src:
+        pixels = src.width * src.height
+    image = load_image(tiff_file, metadata_file)
+    ndvi = calculate_ndvi(tiff_file, metadata_file)
+    out_dir = tempfile.mkdtemp(dir=results_dir)
+
+    def timeseries():
+        store_dir = results_dir + 'timeseries/'
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        calculate_ndvi_timeseries(shapefile, results_dir + 'data/', n_workers=1)
+
+    # name : (function, args, units processed, unit name)
+    benchmarks = {
+        'calculate_ndvi' : (calculate_ndvi, (tiff_file, metadata_file), pixels, 'pixels'),
+        'calculate_ndvi_clipped' : (calculate_ndvi, (tiff_file, metadata_file, None, shapefile), pixels, 'pixels'),
+        'calculate_ndvi_stats' : (calculate_ndvi_stats, (tiff_file, metadata_file, shapefile), pixels, 'pixels'),
+        'calculate_zonal_stats' : (calculate_zonal_stats, (tiff_file, metadata_file, shapefile, 'name'), pixels, 'pixels'),
+        'save_ndvi_tiff' : (calculate_ndvi, (tiff_file, metadata_file, os.path.join(out_dir, 'ndvi.tif')), pixels, 'pixels'),
+        'load_image' : (load_image, (tiff_file, metadata_file), pixels, 'pixels'),
+        'quality_check' : (quality_check, (image,), pixels, 'pixels'),
+        'assess_scene_quality' : (assess_scene_quality, (tiff_file, udm_file), pixels, 'pixels'),
+        'assess_scene_quality_no_udm' : (assess_scene_quality, (tiff_file,), pixels, 'pixels'),
+        'plot_image' : (plot_image, (image, 'benchmark', results_dir), pixels, 'pixels'),
+        'plot_ndvi' : (plot_ndvi, (ndvi, 'benchmark', results_dir), pixels, 'pixels'),
+        'ndvi_timeseries' : (timeseries, (), len(scene_dirs), 'scenes')
+    }
+    if shutil.which('gdalwarp'):
+        def clip():
+            out_file = clip_tiff_by_shapefile(tiff_file, shapefile)
+            os.remove(out_file)
+        benchmarks['clip_tiff_by_shapefile'] = (clip, (), pixels, 'pixels')
+
+    results = {}
+    for name, (func, args, units, unit_name) in benchmarks.items():
+        if stages and name not in stages:
+            continue
+        seconds, peak = measure(func, args, repeat)
+        results[name] = {
+            'seconds' : seconds,
+            'throughput' : units / seconds,
+            'units' : unit_name + '/s',
+            'peak_mb' : peak / 2.**20
+        }
+        if unit_name == 'scenes':
+            results[name]['scenes_per_min'] = units / seconds * 60
+
+    shutil.rmtree(out_dir)
+    return results
+
+def print_results(results, baseline=None):
+    print('{:<30s} {:>10s} {:>16s} {:>10s} {:>9s}'.format('stage', 'seconds', 'throughput', 'peak MB', 'change'))
+    for name, r in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = '{:+.1%}'.format(r['seconds'] / baseline[name]['seconds'] - 1)
+        print('{:<30s} {:>10.4f} {:>12.4g} {:<3s} {:>10.1f} {:>9s}'.format(name, r['seconds'], r['throughput'],
+                                                                           r['units'].split('/')[0][0:3], r['peak_mb'], change))
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    # Stages that got slower, or whose peak memory grew, by more than tolerance
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        b = baseline[name]
+        if r['seconds'] > b['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.4f}s vs {:.4f}s baseline'.format(name, r['seconds'], b['seconds']))
+        if r['peak_mb'] > b['peak_mb'] * (1 + tolerance) and r['peak_mb'] - b['peak_mb'] > 1:
+            regressions.append('{}: {:.1f} MB vs {:.1f} MB baseline'.format(name, r['peak_mb'], b['peak_mb']))
+    return regressions
+
+def load_baseline(filename, config):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        saved = json.load(f)
+    if saved['config'] != config:
+        print("Baseline " + filename + " was recorded with a different configuration, not comparing")
+        return None
+    return saved['results']
+
+def save_baseline(filename, config, results):
+    with open(filename, 'w') as f:
+        json.dump({'config' : config, 'created' : datetime.utcnow().isoformat(), 'results' : results}, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=2048, help='scene width and height in pixels')
+    parser.add_argument('--scenes', type=int, default=8, help='scenes in the end-to-end timeseries run')
+    parser.add_argument('--tiled', action='store_true', help='write tiled instead of striped scenes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage', action='append', help='run only this stage (repeatable)')
+    parser.add_argument('--data-dir', help='keep synthetic data here and reuse it between runs')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {'size' : args.size, 'scenes' : args.scenes, 'tiled' : args.tiled}
+    root = args.data_dir or tempfile.mkdtemp(prefix='ndvi-benchmark-')
+    try:
+        print("Generating synthetic scenes in " + root + "...")
+        results_dir, shapefile = make_synthetic_dataset(root, args.scenes, args.size, args.size, args.tiled)
+        results = run_benchmarks(results_dir, shapefile, args.repeat, args.stage)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(root)
+
+    baseline = load_baseline(args.baseline, config)
+    print_results(results, baseline)
+    if args.save_baseline:
+        save_baseline(args.baseline, config, results)
+        print("Saved baseline to " + args.baseline)
+    elif baseline:
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for r in regressions:
+            print("Regression: " + r)
+        sys.exit(1 if regressions else 0)
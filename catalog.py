@@ -0,0 +1,107 @@
+"""
+Local catalog of Planet search results per AOI, synced incrementally so
+only the window since the last successful search is requested again
+"""
+
+import os, json, hashlib, sqlite3
+
+from datetime import datetime, timedelta
+
+from instrument import timed
+from pl_utils import iter_search_pages
+from settings import SCENE_CATALOG
+
+# Scenes are sometimes published a while after acquisition, so each sync
+# re-queries this far back from the end of the last one
+RESYNC_OVERLAP = timedelta(days=3)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+_connections = {}
+
+def _get_catalog(catalog_filename):
+    # One connection per process, since connections must not cross a fork
+    key = (os.getpid(), catalog_filename)
+    if key not in _connections:
+        catalog_dir = os.path.dirname(catalog_filename)
+        if catalog_dir and not os.path.exists(catalog_dir):
+            os.makedirs(catalog_dir)
+        connection = sqlite3.connect(catalog_filename, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS scenes (aoi TEXT, scene_id TEXT, acquired TEXT, feature TEXT, PRIMARY KEY (aoi, scene_id))")
+        connection.execute("CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (aoi, acquired)")
+        connection.execute("CREATE TABLE IF NOT EXISTS syncs (aoi TEXT PRIMARY KEY, query TEXT, synced_from TEXT, synced_to TEXT)")
+        connection.commit()
+        _connections[key] = connection
+    return _connections[key]
+
+def query_hash(aoi_polygon, item_types):
+    # Identifies what was searched, so a changed AOI polygon or item type
+    # list invalidates the synced window instead of serving stale results
+    query = json.dumps({'polygon' : aoi_polygon, 'item_types' : sorted(item_types)}, sort_keys=True)
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+def sync_windows(datetime_min, datetime_max, synced_from=None, synced_to=None, overlap=RESYNC_OVERLAP):
+    # Sub-windows of [datetime_min, datetime_max] not covered by an earlier
+    # sync of [synced_from, synced_to]
+    if synced_from is None or datetime_max < synced_from or datetime_min > synced_to:
+        return [(datetime_min, datetime_max)]
+
+    windows = []
+    if datetime_min < synced_from:
+        windows.append((datetime_min, synced_from))
+    if datetime_max > synced_to - overlap:
+        windows.append((max(datetime_min, synced_to - overlap), datetime_max))
+    return windows
+
+@timed('search')
+def sync_catalog(aoi, aoi_polygon, datetime_min, datetime_max, item_types=["PSScene4Band"], catalog_filename=SCENE_CATALOG):
+    # Searches the API for the parts of the window not yet in the catalog,
+    # following every result page. The synced window is only extended once
+    # all pages of a search were stored. Returns the number of features fetched
+    connection = _get_catalog(catalog_filename)
+    query = query_hash(aoi_polygon, item_types)
+
+    row = connection.execute("SELECT query, synced_from, synced_to FROM syncs WHERE aoi = ?", (aoi,)).fetchone()
+    if row and row[0] == query:
+        synced_from, synced_to = [datetime.strptime(t, DATE_FORMAT) for t in row[1:3]]
+    else:
+        connection.execute("DELETE FROM scenes WHERE aoi = ?", (aoi,))
+        connection.execute("DELETE FROM syncs WHERE aoi = ?", (aoi,))
+        connection.commit()
+        synced_from = synced_to = None
+
+    n_features = 0
+    for start, end in sync_windows(datetime_min, datetime_max, synced_from, synced_to):
+        for page in iter_search_pages(aoi, aoi_polygon, start, end, item_types):
+            connection.executemany("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?)",
+                                   [(aoi, f['id'], f['properties']['acquired'], json.dumps(f)) for f in page])
+            n_features += len(page)
+
+        # A window disjoint from the synced one replaces it, as the gap
+        # between them was never searched
+        if synced_from is None or start > synced_to or end < synced_from:
+            synced_from, synced_to = start, end
+        else:
+            synced_from, synced_to = min(synced_from, start), max(synced_to, end)
+        connection.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)",
+                           (aoi, query, synced_from.strftime(DATE_FORMAT), synced_to.strftime(DATE_FORMAT)))
+        connection.commit()
+
+    return n_features
+
+def catalog_scenes(aoi, datetime_min=None, datetime_max=None, catalog_filename=SCENE_CATALOG):
+    # Catalogued features for the AOI in order of acquisition, without any
+    # API requests
+    sql = "SELECT feature FROM scenes WHERE aoi = ?"
+    params = [aoi]
+    if datetime_min:
+        sql += " AND acquired >= ?"
+        params.append(datetime_min.strftime(DATE_FORMAT))
+    if datetime_max:
+        sql += " AND acquired <= ?"
+        params.append(datetime_max.strftime(DATE_FORMAT) + 'Z')
+    sql += " ORDER BY acquired"
+    return [json.loads(row[0]) for row in _get_catalog(catalog_filename).execute(sql, params)]
+
+def search_catalog(aoi, aoi_polygon, datetime_min, datetime_max, item_types=["PSScene4Band"], catalog_filename=SCENE_CATALOG):
+    sync_catalog(aoi, aoi_polygon, datetime_min, datetime_max, item_types, catalog_filename)
+    return catalog_scenes(aoi, datetime_min, datetime_max, catalog_filename)
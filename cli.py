@@ -0,0 +1,288 @@
+"""
+Command line entry point for the NDVI monitoring pipeline. Each subcommand
+imports the modules it needs when it runs, so short invocations only pay for
+their own dependencies
+"""
+
+import os, re, sys, json
+import argparse, subprocess
+
+from datetime import datetime, timedelta
+
+from settings import DATA_DIR, JOB_WORKERS, N_WORKERS, PL_AOIS
+
+# Modules each subcommand imports, and the budget in seconds for importing
+# them in a fresh interpreter (None: not checked)
+COMMAND_MODULES = {
+    'cli' : ['cli'],
+    'search' : ['catalog'],
+    'download' : ['catalog', 'jobs', 'pl_utils'],
+    'compute' : ['ndvi'],
+    'plot' : ['ndvi'],
+    'gif' : ['prep_gif'],
+    'composite' : ['composite'],
+    'trend' : ['trend'],
+    'publish' : ['s3utils']
+}
+IMPORT_BUDGETS = {
+    'cli' : 0.2,
+    'search' : 0.5,
+    'download' : 0.5,
+    'compute' : 1.5,
+    'plot' : 1.5,
+    'gif' : 1.5,
+    'composite' : 1.5,
+    'trend' : 1.5,
+    'publish' : 1.0
+}
+
+# Heavy packages no subcommand should import unless it needs them, and the
+# ones each subcommand does need (rasterio brings boto3 for its AWS sessions)
+HEAVY_MODULES = ['matplotlib', 'scipy', 'osgeo', 'rasterio', 'pandas', 'boto', 'boto3', 'botocore']
+RASTERIO_MODULES = ['rasterio', 'boto3', 'botocore']
+COMMAND_HEAVY_MODULES = {
+    'cli' : [],
+    'search' : [],
+    'download' : [],
+    'compute' : RASTERIO_MODULES + ['pandas'],
+    'plot' : RASTERIO_MODULES + ['pandas'],
+    'gif' : RASTERIO_MODULES,
+    'composite' : RASTERIO_MODULES + ['pandas'],
+    'trend' : RASTERIO_MODULES,
+    'publish' : ['boto']
+}
+
+def aoi_paths(aoi, data_dir=DATA_DIR):
+    # (results_dir, AOI polygon, shapefile) as laid out by the daily run
+    with open('polygons/' + aoi + '.json', 'r') as f:
+        aoi_polygon = json.load(f)
+    return data_dir + aoi + '/', aoi_polygon, 'shp/' + aoi + '.shp'
+
+def time_window(args):
+    datetime_max = args.end or datetime.utcnow()
+    datetime_min = args.start or datetime_max - timedelta(days=args.days)
+    return datetime_min, datetime_max
+
+def run_reported(name, results_dir, func, *args):
+    # Runs one AOI's stage under its own run report
+    from instrument import start_report
+    report = start_report(name)
+    try:
+        return func(*args)
+    finally:
+        report.print_summary()
+        report.write(results_dir + 'reports/')
+
+def search(args):
+    from catalog import search_catalog
+    datetime_min, datetime_max = time_window(args)
+    for aoi in args.aois:
+        results_dir, aoi_polygon, shape_file = aoi_paths(aoi, args.data_dir)
+        scenes = search_catalog(aoi, aoi_polygon, datetime_min, datetime_max)
+        print("{}: {:d} scenes from {} to {}".format(aoi.upper(), len(scenes), datetime_min.date(), datetime_max.date()))
+        if args.verbose:
+            for f in scenes:
+                print("  " + f['id'] + " " + f['properties']['acquired'])
+
+def _download(aoi, results_dir, aoi_polygon, datetime_min, datetime_max, n_workers):
+    from catalog import catalog_scenes
+    from jobs import JobQueue, run_scene_jobs
+
+    for d in ['', 'data/']:
+        if not os.path.exists(results_dir + d):
+            os.makedirs(results_dir + d)
+    downloaded = os.listdir(results_dir + 'data/')
+    features = [f for f in catalog_scenes(aoi, datetime_min, datetime_max) if f['id'] not in downloaded]
+
+    # Queued like the daily run's scenes, which then only need processing
+    print("{}: downloading {:d} scenes...".format(aoi.upper(), len(features)))
+    queue = JobQueue()
+    queue.enqueue(aoi, features)
+    counts = run_scene_jobs(queue, aoi, aoi_polygon, results_dir, n_workers, process=False)
+    for job in queue.failed_jobs(aoi):
+        print("Failed to download {scene_id} ({state}, {attempts:d} attempts): {error}".format(**job))
+    return counts['failed']
+
+def download(args):
+    # Clips and downloads catalogued scenes without plotting; run search
+    # first to refresh the catalog
+    datetime_min, datetime_max = time_window(args)
+    failed = 0
+    for aoi in args.aois:
+        results_dir, aoi_polygon, shape_file = aoi_paths(aoi, args.data_dir)
+        failed += run_reported('download-' + aoi, results_dir, _download, aoi, results_dir, aoi_polygon, datetime_min, datetime_max, args.workers)
+    return 1 if failed else 0
+
+def compute(args):
+    from ndvi import save_all_tiffs, update_ndvi_timeseries_incremental
+    for aoi in args.aois:
+        results_dir, aoi_polygon, shape_file = aoi_paths(aoi, args.data_dir)
+        data = run_reported('compute-' + aoi, results_dir, update_ndvi_timeseries_incremental, shape_file, results_dir, args.workers)
+        print("{}: {:d} scenes in timeseries".format(aoi.upper(), len(data)))
+        if args.tiffs:
+            save_all_tiffs(results_dir + 'data/')
+
+def _plot(aoi, results_dir, aoi_polygon):
+    from ndvi import get_timeseries_store, list_scene_dirs, make_results_dirs, plot_ndvi_timeseries, plot_scene
+
+    make_results_dirs(results_dir)
+    scene_ids = [s for s in list_scene_dirs(results_dir + 'data/') if not os.path.exists(results_dir + 'img/ndvi_' + s + '.png')]
+    print("{}: plotting {:d} scenes...".format(aoi.upper(), len(scene_ids)))
+    for scene_id in scene_ids:
+        try:
+            plot_scene(results_dir + 'data/' + scene_id, scene_id, aoi_polygon, results_dir)
+        except (KeyError, ValueError) as e:
+            print("Failed to plot " + scene_id + ": " + str(e))
+
+    data = get_timeseries_store(results_dir).read()
+    if not data.empty:
+        plot_ndvi_timeseries(data, aoi.upper(), results_dir)
+
+def plot(args):
+    for aoi in args.aois:
+        results_dir, aoi_polygon, shape_file = aoi_paths(aoi, args.data_dir)
+        run_reported('plot-' + aoi, results_dir, _plot, aoi, results_dir, aoi_polygon)
+
+def gif(args):
+    from prep_gif import make_ndvi_animation
+    for aoi in args.aois:
+        results_dir = args.data_dir + aoi + '/'
+        gif_dir = results_dir + 'gif/'
+        if not os.path.exists(gif_dir):
+            os.mkdir(gif_dir)
+        make_ndvi_animation(results_dir + 'cube/', gif_dir + 'ndvi_' + aoi + '.' + args.format,
+                            max_size=args.max_size, fps=args.fps, start=args.start, end=args.end, n_workers=args.workers)
+
+def composite(args):
+    from composite import composite_cube, update_composite
+    build = composite_cube if args.rebuild else update_composite
+    for aoi in args.aois:
+        results_dir = args.data_dir + aoi + '/'
+        source = results_dir + ('cube/' if args.freq in ['pass', 'day'] else 'mosaic/')
+        cube = build(source, results_dir + (args.out or args.freq + '_' + args.how) + '/', args.freq, args.how, args.min_frames)
+        print("{}: {:d} {} composites".format(aoi.upper(), len(cube.scenes), args.freq))
+
+def trend(args):
+    # Per-pixel trends and breaks from the daily mosaic, or the raw cube
+    # when no mosaic has been built
+    from trend import analyze_cube
+    for aoi in args.aois:
+        results_dir = args.data_dir + aoi + '/'
+        source = results_dir + ('mosaic/' if os.path.exists(results_dir + 'mosaic/cube.json') else 'cube/')
+        filenames = run_reported('trend-' + aoi, results_dir, analyze_cube, source, results_dir + 'trend/',
+                                 args.harmonics, args.min_obs, args.start, args.end, args.workers)
+        if filenames:
+            print("{}: wrote {}".format(aoi.upper(), ', '.join(sorted(filenames.values()))))
+
+def publish(args):
+    from s3utils import sync_dir_to_s3
+    for aoi in args.aois:
+        results_dir = args.data_dir + aoi + '/'
+        for d in args.dirs:
+            if os.path.exists(results_dir + d):
+                uploaded = sync_dir_to_s3(results_dir + d, aoi + '/' + d, policy='public-read', delete=args.delete)
+                print("{}: uploaded {:d} files from {}".format(aoi.upper(), len(uploaded), d))
+
+def loaded_packages(modules):
+    # Top-level packages in sys.modules after importing modules in a fresh
+    # interpreter
+    code = 'import sys, {}; print(" ".join(sorted(set(m.split(".")[0] for m in sys.modules))))'.format(', '.join(modules))
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+    return set(process.stdout.split())
+
+def import_time(modules):
+    # Seconds spent importing modules in a fresh interpreter, from -X importtime
+    command = [sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+
+    # Top-level entries carry the cumulative time of everything they pulled in
+    total = 0
+    for line in process.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            total += int(match.group(1))
+    return total / 1e6
+
+def check_imports(args):
+    # Benchmark of each subcommand's import time against its budget; fails
+    # if any is over. Timings vary between machines, so the tests check
+    # which packages are imported instead (see loaded_packages)
+    failed = 0
+    for command, modules in COMMAND_MODULES.items():
+        budget = IMPORT_BUDGETS[command]
+        try:
+            seconds = import_time(modules)
+        except ImportError as e:
+            print("{:<10s} import failed: {}".format(command, e))
+            failed += 1
+            continue
+        over = budget is not None and seconds > budget
+        failed += int(over)
+        print("{:<10s} {:>7.3f} s  budget {:>5s}  {}".format(command, seconds, '{:.2f}'.format(budget) if budget else '-', 'OVER' if over else 'ok'))
+    return 1 if failed else 0
+
+def parse_date(s):
+    return datetime.strptime(s, '%Y-%m-%d')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="NDVI monitoring with PlanetScope imagery")
+    parser.add_argument('--data-dir', default=DATA_DIR, help="results root, one directory per AOI")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def add_command(name, func, help, aois=True, window=False, workers=False):
+        p = commands.add_parser(name, help=help)
+        p.set_defaults(func=func)
+        if aois:
+            p.add_argument('aois', nargs='*', default=PL_AOIS, help="AOI names (default: PL_AOIS)")
+        if window:
+            p.add_argument('--days', type=float, default=365 / 2, help="window length ending at --end")
+            p.add_argument('--start', type=parse_date)
+            p.add_argument('--end', type=parse_date)
+        if workers:
+            p.add_argument('--workers', type=int, default=N_WORKERS)
+        return p
+
+    p = add_command('search', search, "sync the scene catalog with Planet search results", window=True)
+    p.add_argument('-v', '--verbose', action='store_true')
+    p = add_command('download', download, "clip and download catalogued scenes", window=True)
+    p.add_argument('--workers', type=int, default=JOB_WORKERS)
+    p = add_command('compute', compute, "update NDVI timeseries from downloaded scenes", workers=True)
+    p.add_argument('--tiffs', action='store_true', help="also write NDVI GeoTIFFs")
+    add_command('plot', plot, "render scene images and timeseries plots")
+    p = add_command('gif', gif, "animate the NDVI datacube", workers=True)
+    p.add_argument('--format', choices=['gif', 'mp4'], default='gif')
+    p.add_argument('--max-size', type=int, default=512)
+    p.add_argument('--fps', type=int, default=4)
+    p.add_argument('--start', type=parse_date)
+    p.add_argument('--end', type=parse_date)
+    p = add_command('composite', composite, "mosaic same-day scenes or composite the daily mosaics")
+    p.add_argument('--freq', choices=['pass', 'day', 'week', 'month'], default='day')
+    p.add_argument('--how', choices=['first', 'mean', 'median', 'max'], default='median')
+    p.add_argument('--min-frames', type=int, default=1)
+    p.add_argument('--out', help="output cube directory under the AOI (default: <freq>_<how>)")
+    p.add_argument('--rebuild', action='store_true', help="recompute every period, not just those with new scenes")
+    p = add_command('trend', trend, "fit per-pixel seasonal trends and detect NDVI breaks", workers=True)
+    p.add_argument('--harmonics', type=int, default=2)
+    p.add_argument('--min-obs', type=int, default=12)
+    p.add_argument('--start', type=parse_date)
+    p.add_argument('--end', type=parse_date)
+    p = add_command('publish', publish, "sync results to S3")
+    p.add_argument('--dirs', nargs='+', default=['img/', 'ts/', 'gif/'])
+    p.add_argument('--delete', action='store_true', help="remove remote files with no local counterpart")
+    add_command('check-imports', check_imports, "check subcommand import times against their budgets", aois=False)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
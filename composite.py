@@ -0,0 +1,153 @@
+"""
+Same-day mosaics and weekly/monthly composites of an AOI's NDVI datacube,
+computed tile by tile and vectorized over the time axis
+"""
+
+import os, shutil
+import warnings
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+from datacube import NDVICube, NODATA, scale_ndvi, unscale_ndvi
+from stats import StreamingStats
+from timeseries import COLUMNS as TIMESERIES_COLUMNS
+
+REDUCERS = {
+    'mean' : np.nanmean,
+    'median' : np.nanmedian,
+    'max' : np.nanmax
+}
+
+def satellite_id(scene):
+    # PlanetScope ids end in the satellite id, e.g. 20180501_181234_0f4e
+    return scene.rsplit('_', 1)[-1]
+
+def group_frames(times, scenes, freq='day'):
+    # [(period start, member frame indices)] in time order. 'pass' groups
+    # scenes of one satellite on one day (adjacent strips of a single
+    # pass); 'day', 'week' (ISO, from Monday) and 'month' group by date
+    groups = {}
+    for i, (t, scene) in enumerate(zip(times, scenes)):
+        day = datetime(t.year, t.month, t.day)
+        if freq == 'pass':
+            key = (day, satellite_id(scene))
+        elif freq == 'day':
+            key = day
+        elif freq == 'week':
+            key = day - timedelta(days=day.weekday())
+        elif freq == 'month':
+            key = datetime(t.year, t.month, 1)
+        else:
+            raise ValueError("Unknown composite frequency " + freq)
+        groups.setdefault(key, []).append(i)
+
+    result = []
+    for key, members in groups.items():
+        members = sorted(members, key=lambda i: times[i])
+        start = times[members[0]] if freq in ['pass', 'day'] else key
+        result.append((start, members))
+    return sorted(result, key=lambda g: g[0])
+
+def reduce_frames(tile, members, how='median'):
+    # (len(groups), y, x) int16 composite of one tile for every group at
+    # once; 'first' takes each pixel from the earliest frame that has it
+    frames = np.empty((len(members),) + tile.shape[1:], dtype=np.int16)
+    for k, indices in enumerate(members):
+        group = tile[indices]
+        if how == 'first':
+            valid = group != NODATA
+            first = np.argmax(valid, axis=0)
+            frames[k] = np.take_along_axis(group, first[np.newaxis], axis=0)[0]
+            continue
+        with warnings.catch_warnings():
+            # All-NaN pixels (no valid frame in the group) stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            frames[k] = scale_ndvi(REDUCERS[how](unscale_ndvi(group), axis=0))
+    return frames
+
+def composite_cube(cube_root, out_root, freq='day', how='mean', min_frames=1):
+    # Writes a cube at out_root with one frame per group of cube_root's
+    # frames (see group_frames). Frames are built in a temporary directory,
+    # the old cube is renamed aside and the new one renamed into place
+    # before the old one is removed, so readers never see a partially
+    # written cube (though out_root is briefly missing between the renames)
+    source = NDVICube(cube_root)
+    groups = [(start, members) for start, members in group_frames(source.times, source.scenes, freq) if len(members) >= min_frames]
+    times = [start for start, members in groups]
+    scenes = ['+'.join([source.scenes[i] for i in members]) for start, members in groups]
+    members = [members for start, members in groups]
+
+    tmp_root = out_root.rstrip('/') + '.tmp'
+    old_root = out_root.rstrip('/') + '.old'
+    for root in [tmp_root, old_root]:
+        if os.path.exists(root):
+            shutil.rmtree(root)
+    NDVICube.derive(tmp_root, source, times, scenes, lambda tile: reduce_frames(tile, members, how))
+    if os.path.exists(out_root):
+        os.rename(out_root.rstrip('/'), old_root)
+    os.rename(tmp_root, out_root.rstrip('/'))
+    if os.path.exists(old_root):
+        shutil.rmtree(old_root)
+
+    return NDVICube(out_root)
+
+def update_composite(cube_root, out_root, freq='day', how='mean', min_frames=1):
+    # Brings a cube written by composite_cube up to date with frames added
+    # to cube_root since, recomputing only the groups whose members changed:
+    # a group sharing scenes with an existing frame replaces it, other
+    # groups are appended. Falls back to a full build if there is no
+    # output yet or it cannot be matched to the current groups
+    if not os.path.exists(os.path.join(out_root, 'cube.json')):
+        return composite_cube(cube_root, out_root, freq, how, min_frames)
+    source = NDVICube(cube_root)
+    out = NDVICube(out_root)
+    if out.header['transform'] != source.header['transform'] or (out.width, out.height) != (source.width, source.height):
+        return composite_cube(cube_root, out_root, freq, how, min_frames)
+
+    # Frames are named by their members, and members by their scene ids
+    frame_of_scene = {}
+    for i, name in enumerate(out.scenes):
+        for scene in name.split('+'):
+            frame_of_scene[scene] = i
+
+    updates = []
+    members = []
+    for start, indices in group_frames(source.times, source.scenes, freq):
+        name = '+'.join([source.scenes[i] for i in indices])
+        if len(indices) < min_frames or name in out.scenes:
+            continue
+        frames = set([frame_of_scene[s] for s in name.split('+') if s in frame_of_scene])
+        if len(frames) > 1:
+            return composite_cube(cube_root, out_root, freq, how, min_frames)
+        updates.append((frames.pop() if frames else None, start, name))
+        members.append(indices)
+
+    if updates:
+        out.update_derived(source, updates, lambda tile: reduce_frames(tile, members, how))
+    return NDVICube(out_root)
+
+def mosaic_daily(cube_root, out_root, how='mean'):
+    # Joins scenes acquired on the same day (e.g. an AOI split across
+    # adjacent strips) into one frame each
+    return composite_cube(cube_root, out_root, 'day', how)
+
+def cube_timeseries(cube):
+    # Per-frame NDVI statistics of a (mosaic or composite) cube over its
+    # grid, accumulated tile by tile, in the timeseries store's columns and
+    # in time order (updated cubes append frames out of order)
+    stats = [StreamingStats() for t in cube.header['times']]
+    for filename, row, col, shape in cube.tiles():
+        tile = cube.tile_array(filename, shape)
+        for i, s in enumerate(stats):
+            s.update(unscale_ndvi(tile[i]))
+
+    records = []
+    for scene, s in zip(cube.scenes, stats):
+        record = s.record()
+        record['scene'] = scene
+        records.append(record)
+    index = pd.DatetimeIndex(cube.times, name='date')
+    data = pd.DataFrame(records, index=index, columns=TIMESERIES_COLUMNS)
+    return data[data['count'] > 0].sort_index()
@@ -0,0 +1,240 @@
+"""
+Per-AOI NDVI datacube (time x y x x) on a common grid, stored as scaled
+int16 tiles that are memory-mapped for reading
+"""
+
+import os, json, uuid, fcntl
+import numpy as np
+import rasterio
+
+from contextlib import contextmanager
+from datetime import datetime
+from rasterio.crs import CRS
+from rasterio.warp import reproject, transform_geom, Resampling
+
+SCALE = 1e-4
+NODATA = -32768
+TILE_SIZE = 64
+
+@contextmanager
+def cube_lock(root):
+    # Exclusive lock on a cube directory, held by writers in any process
+    # from reading the header to replacing it
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _fit_tile(f, n_bytes):
+    # Cuts an open tile file back to n_bytes, dropping any frame left over
+    # from an interrupted write, or pads a short one out with NODATA.
+    # truncate alone would zero-fill, and 0 reads back as NDVI 0.0
+    size = f.seek(0, os.SEEK_END)
+    if size >= n_bytes:
+        f.truncate(n_bytes)
+        return
+    size -= size % 2
+    f.truncate(size)
+    f.seek(size)
+    f.write(np.full((n_bytes - size) // 2, NODATA, dtype=np.int16).tobytes())
+
+def _write_header(root, header):
+    # Written under a unique name and renamed, so readers never see a
+    # partial header and concurrent writers never share a temporary file
+    filename = os.path.join(root, 'cube.json')
+    tmp_filename = '{}.{}.tmp'.format(filename, uuid.uuid4().hex[0:8])
+    with open(tmp_filename, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_filename, filename)
+
+def grid_from_polygon(aoi_polygon, crs, resolution=3.0):
+    # Transform and shape of a grid covering the AOI polygon in crs, snapped
+    # to multiples of resolution
+    geometry = transform_geom('EPSG:4326', crs, aoi_polygon)
+    coords = np.array(geometry['coordinates'][0])
+    xmin = np.floor(coords[:, 0].min() / resolution) * resolution
+    xmax = np.ceil(coords[:, 0].max() / resolution) * resolution
+    ymin = np.floor(coords[:, 1].min() / resolution) * resolution
+    ymax = np.ceil(coords[:, 1].max() / resolution) * resolution
+
+    transform = rasterio.Affine(resolution, 0, xmin, 0, -resolution, ymax)
+    return transform, int(round((xmax - xmin) / resolution)), int(round((ymax - ymin) / resolution))
+
+def scale_ndvi(ndvi):
+    scaled = np.round(np.clip(ndvi, -1, 1) / SCALE)
+    scaled[np.isnan(ndvi)] = NODATA
+    return scaled.astype(np.int16)
+
+def unscale_ndvi(scaled):
+    ndvi = scaled.astype(np.float32) * np.float32(SCALE)
+    ndvi[scaled == NODATA] = np.nan
+    return ndvi
+
+class NDVICube(object):
+    """
+    Each TILE_SIZE x TILE_SIZE spatial tile is one file of int16 frames
+    appended in order of arrival, so a date is one contiguous
+    frame per tile and a pixel's full history lives in a single file.
+    cube.json holds the grid, tile size and the time/scene of each frame.
+    Appends from several processes are serialised with cube_lock
+    """
+    def __init__(self, root):
+        self.root = root
+        self._load_header()
+        self.crs = CRS.from_wkt(self.header['crs'])
+        self.transform = rasterio.Affine(*self.header['transform'])
+        self.width = self.header['width']
+        self.height = self.header['height']
+        self.tile_size = self.header['tile_size']
+
+    @classmethod
+    def create(cls, root, crs, transform, width, height, tile_size=TILE_SIZE):
+        os.makedirs(os.path.join(root, 'tiles'), exist_ok=True)
+        header = {
+            'crs' : CRS.from_user_input(crs).to_wkt(),
+            'transform' : list(transform)[0:6],
+            'width' : width,
+            'height' : height,
+            'tile_size' : tile_size,
+            'times' : [],
+            'scenes' : []
+        }
+        _write_header(root, header)
+        return cls(root)
+
+    @property
+    def times(self):
+        return [datetime.strptime(t, '%Y-%m-%dT%H:%M:%S') for t in self.header['times']]
+
+    @property
+    def scenes(self):
+        return self.header['scenes']
+
+    def _load_header(self):
+        with open(os.path.join(self.root, 'cube.json'), 'r') as f:
+            self.header = json.load(f)
+
+    def _save_header(self):
+        _write_header(self.root, self.header)
+
+    def tiles(self):
+        # (tile filename, window row/col offsets and shape) for every tile
+        for row in range(0, self.height, self.tile_size):
+            for col in range(0, self.width, self.tile_size):
+                shape = (min(self.tile_size, self.height - row), min(self.tile_size, self.width - col))
+                filename = os.path.join(self.root, 'tiles', '{:d}_{:d}.i2'.format(row, col))
+                yield filename, row, col, shape
+
+    def tile_array(self, filename, shape):
+        # Memory-mapped (time, y, x) int16 view of one tile
+        n = len(self.header['times'])
+        if n == 0:
+            return np.empty((0,) + shape, dtype=np.int16)
+        return np.memmap(filename, dtype=np.int16, mode='r', shape=(n,) + shape)
+
+    def append(self, ndvi, transform, crs, time, scene):
+        # Reprojects one scene's NDVI onto the cube grid and appends it as a
+        # new frame. Returns False if the scene is already in the cube
+        if scene in self.header['scenes']:
+            return False
+
+        frame = np.full((self.height, self.width), np.nan, dtype=np.float32)
+        reproject(ndvi.astype(np.float32), frame, src_transform=transform, src_crs=crs, src_nodata=np.nan,
+                  dst_transform=self.transform, dst_crs=self.crs, dst_nodata=np.nan, resampling=Resampling.bilinear)
+        frame = scale_ndvi(frame)
+
+        with cube_lock(self.root):
+            # Other processes may have appended since this cube was opened
+            self._load_header()
+            if scene in self.header['scenes']:
+                return False
+
+            n = len(self.header['times'])
+            for filename, row, col, shape in self.tiles():
+                with open(filename, 'ab') as f:
+                    _fit_tile(f, n * shape[0] * shape[1] * 2)
+                    f.write(np.ascontiguousarray(frame[row:row + shape[0], col:col + shape[1]]).tobytes())
+
+            self.header['times'].append(time.strftime('%Y-%m-%dT%H:%M:%S'))
+            self.header['scenes'].append(scene)
+            self._save_header()
+        return True
+
+    @classmethod
+    def derive(cls, root, source, times, scenes, tile_frames):
+        # New cube on source's grid with one frame per entry of times and
+        # scenes, built tile by tile: tile_frames(tile) is given source's
+        # (time, y, x) int16 tile and returns the derived (n, y, x) frames
+        cube = cls.create(root, source.crs, source.transform, source.width, source.height, source.tile_size)
+        for (source_file, row, col, shape), (filename, _, _, _) in zip(source.tiles(), cube.tiles()):
+            frames = tile_frames(source.tile_array(source_file, shape))
+            with open(filename, 'wb') as f:
+                f.write(np.ascontiguousarray(frames, dtype=np.int16).tobytes())
+
+        cube.header['times'] = [t.strftime('%Y-%m-%dT%H:%M:%S') for t in times]
+        cube.header['scenes'] = list(scenes)
+        cube._save_header()
+        return cube
+
+    def update_derived(self, source, updates, tile_frames):
+        # Rewrites some frames of a cube made by derive and appends others.
+        # updates is a list of (frame index, or None to append, time, scene)
+        # and tile_frames returns one frame per update. An interrupted update
+        # leaves the header as it was, so the same update can be rerun
+        with cube_lock(self.root):
+            self._load_header()
+            n = len(self.header['times'])
+            positions = []
+            for index, time, scene in updates:
+                if index is None:
+                    index = n + len([p for p in positions if p >= n])
+                positions.append(index)
+
+            for (source_file, row, col, shape), (filename, _, _, _) in zip(source.tiles(), self.tiles()):
+                frames = np.ascontiguousarray(tile_frames(source.tile_array(source_file, shape)), dtype=np.int16)
+                frame_bytes = shape[0] * shape[1] * 2
+                with open(filename, 'r+b') as f:
+                    _fit_tile(f, n * frame_bytes)
+                    for frame, index in zip(frames, positions):
+                        f.seek(index * frame_bytes)
+                        f.write(frame.tobytes())
+
+            for (index, time, scene), position in zip(updates, positions):
+                if position == len(self.header['times']):
+                    self.header['times'].append(None)
+                    self.header['scenes'].append(None)
+                self.header['times'][position] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                self.header['scenes'][position] = scene
+            self._save_header()
+
+    def read_frame(self, i):
+        ndvi = np.empty((self.height, self.width), dtype=np.float32)
+        for filename, row, col, shape in self.tiles():
+            ndvi[row:row + shape[0], col:col + shape[1]] = unscale_ndvi(self.tile_array(filename, shape)[i])
+        return ndvi
+
+    def read_pixel(self, row, col):
+        # NDVI history of one pixel, in frame order (see times)
+        tile_row = row - row % self.tile_size
+        tile_col = col - col % self.tile_size
+        shape = (min(self.tile_size, self.height - tile_row), min(self.tile_size, self.width - tile_col))
+        filename = os.path.join(self.root, 'tiles', '{:d}_{:d}.i2'.format(tile_row, tile_col))
+        return unscale_ndvi(self.tile_array(filename, shape)[:, row - tile_row, col - tile_col])
+
+    def read_xy(self, x, y):
+        row, col = rasterio.transform.rowcol(self.transform, x, y)
+        return self.read_pixel(row, col)
+
+def open_cube(root, aoi_polygon, crs, resolution=3.0):
+    # Opens the AOI's cube, creating it on a grid covering the AOI polygon
+    # in the CRS of the first scene if it does not exist yet
+    if os.path.exists(os.path.join(root, 'cube.json')):
+        return NDVICube(root)
+    with cube_lock(root):
+        if os.path.exists(os.path.join(root, 'cube.json')):
+            return NDVICube(root)
+        transform, width, height = grid_from_polygon(aoi_polygon, crs, resolution)
+        return NDVICube.create(root, crs, transform, width, height)
@@ -0,0 +1,175 @@
+"""
+Per-stage timers, byte counters and peak memory for pipeline runs, written
+out as JSON/CSV run reports with optional cProfile dumps
+"""
+
+import os, csv, json, time, resource, cProfile
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+
+from settings import PROFILE_RUNS
+
+STAGES = ['search', 'activate', 'clip', 'download', 'extract', 'qa', 'clip_to_shape', 'load', 'ndvi', 'stats', 'plot', 'cube', 'composite', 'trend', 's3_upload', 's3_download']
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+class RunReport(object):
+    """
+    Call counts, cumulative seconds, errors and bytes per stage, shared by
+    all threads of a run. Stage time is summed over calls, so concurrent
+    stages (clip polling, downloads) can add up to more than the wall time,
+    and stages may nest (clip_to_shape runs inside ndvi). Stages recorded in
+    pool worker processes are merged in when run through WorkerTask.
+    peak_rss_growth_mb is the most any one call raised the process's peak
+    RSS, so it shows which stages set new memory highs
+    """
+    def __init__(self, name, profile=PROFILE_RUNS):
+        self.name = name
+        self.started = datetime.utcnow()
+        self.start_time = time.perf_counter()
+        self.stages = defaultdict(lambda: {'count' : 0, 'errors' : 0, 'seconds' : 0.0, 'bytes' : 0, 'peak_rss_growth_mb' : 0.0})
+        self._lock = Lock()
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def record(self, stage, seconds, error=False, nbytes=0, rss_growth=0.0):
+        with self._lock:
+            s = self.stages[stage]
+            s['count'] += 1
+            s['errors'] += int(error)
+            s['seconds'] += seconds
+            s['bytes'] += nbytes
+            s['peak_rss_growth_mb'] = max(s['peak_rss_growth_mb'], rss_growth)
+
+    def merge(self, stages):
+        # Adds stage records made by another process's report
+        with self._lock:
+            for stage, other in stages.items():
+                s = self.stages[stage]
+                for k in ['count', 'errors', 'seconds', 'bytes']:
+                    s[k] += other[k]
+                s['peak_rss_growth_mb'] = max(s['peak_rss_growth_mb'], other['peak_rss_growth_mb'])
+
+    def add_bytes(self, stage, nbytes):
+        with self._lock:
+            self.stages[stage]['bytes'] += nbytes
+
+    def summary(self):
+        return {
+            'name' : self.name,
+            'started' : self.started.isoformat(),
+            'seconds' : time.perf_counter() - self.start_time,
+            'peak_rss_mb' : peak_rss_mb(),
+            'children_peak_rss_mb' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.,
+            'stages' : {k : dict(v) for k, v in sorted(self.stages.items(), key=lambda kv: _stage_order(kv[0]))}
+        }
+
+    def write(self, report_dir):
+        # report_dir/run-<name>-<start>.json and .csv, plus .prof when profiling
+        if not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+        summary = self.summary()
+        base = os.path.join(report_dir, 'run-{}-{}'.format(self.name, self.started.strftime('%Y%m%dT%H%M%S')))
+
+        with open(base + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        with open(base + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count', 'errors', 'seconds', 'bytes', 'mb_per_s', 'peak_rss_growth_mb'])
+            for stage, s in summary['stages'].items():
+                rate = s['bytes'] / 2.**20 / s['seconds'] if s['seconds'] and s['bytes'] else ''
+                writer.writerow([stage, s['count'], s['errors'], '{:.3f}'.format(s['seconds']), s['bytes'], rate, '{:.1f}'.format(s['peak_rss_growth_mb'])])
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(base + '.prof')
+            self.profiler.enable()
+
+        return base + '.json'
+
+    def print_summary(self):
+        summary = self.summary()
+        print("Run {name}: {seconds:.1f} s, peak RSS {peak_rss_mb:.0f} MB".format(**summary))
+        for stage, s in summary['stages'].items():
+            line = "  {:<14s} {:>6d} calls {:>10.2f} s".format(stage, s['count'], s['seconds'])
+            if s['bytes']:
+                line += " {:>10.1f} MB".format(s['bytes'] / 2.**20)
+            if s['errors']:
+                line += " ({:d} errors)".format(s['errors'])
+            print(line)
+
+def _stage_order(stage):
+    return (STAGES.index(stage) if stage in STAGES else len(STAGES), stage)
+
+_report = None
+
+def start_report(name, profile=PROFILE_RUNS):
+    # Makes a new report current for every instrumented stage
+    global _report
+    if _report is not None and _report.profiler is not None:
+        _report.profiler.disable()
+    _report = RunReport(name, profile)
+    return _report
+
+def get_report():
+    # Stages run outside start_report go to a default report
+    global _report
+    if _report is None:
+        _report = RunReport('default', profile=False)
+    return _report
+
+@contextmanager
+def stage(name, nbytes=0):
+    report = get_report()
+    start = time.perf_counter()
+    start_rss = peak_rss_mb()
+    error = False
+    try:
+        yield report
+    except BaseException:
+        error = True
+        raise
+    finally:
+        report.record(name, time.perf_counter() - start, error, nbytes, peak_rss_mb() - start_rss)
+
+def timed(name):
+    # Decorator recording every call of a function as stage name
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_bytes(name, nbytes):
+    get_report().add_bytes(name, nbytes)
+
+class WorkerTask(object):
+    """
+    Picklable wrapper for a function mapped over a process pool. Each call
+    records into a fresh report in the worker, and returns the function's
+    result with that report's stages, for merge_worker_result in the parent
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, args):
+        report = start_report('worker', profile=False)
+        return self.func(args), dict(report.stages)
+
+def merge_worker_result(item):
+    # Adds a WorkerTask call's stages to this process's report and returns
+    # the call's result
+    result, stages = item
+    get_report().merge(stages)
+    return result
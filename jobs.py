@@ -0,0 +1,233 @@
+"""
+Durable per-scene job queue in SQLite, so interrupted runs resume each scene
+from the last completed step instead of repeating clip jobs and downloads,
+and the worker processes that run each scene's steps
+"""
+
+import os, json, time, socket, sqlite3
+
+from multiprocessing import Pool
+
+from instrument import WorkerTask, merge_worker_result
+from settings import JOB_QUEUE, JOB_WORKERS
+
+# Scene states in pipeline order; each step moves a job to the next one
+SEARCHED = 'searched'
+CLIP_SUBMITTED = 'clip_submitted'
+CLIPPED = 'clipped'
+DOWNLOADED = 'downloaded'
+PROCESSED = 'processed'
+PUBLISHED = 'published'
+STATES = [SEARCHED, CLIP_SUBMITTED, CLIPPED, DOWNLOADED, PROCESSED, PUBLISHED]
+
+LEASE = 15*60 # s; claims older than this are assumed to be from dead workers
+MAX_ATTEMPTS = 5
+BACKOFF = 30 # s, doubled after each failed attempt
+CLIP_TIMEOUT = 5*60 # s a clip job may stay queued or running before it is resubmitted
+POLL_INTERVAL = 10 # s between checks on a running clip job
+
+_connections = {}
+
+class JobQueue(object):
+    """
+    One row per (AOI, scene) with its state, clip/download URLs, attempt
+    count and the time it may next be tried. Workers in any number of
+    processes claim jobs in an immediate transaction, so a job is only
+    worked on by one of them at a time; a claim that is not released within
+    LEASE (e.g. the worker was killed) lapses and the job is picked up again
+    """
+    def __init__(self, filename=JOB_QUEUE, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    @property
+    def connection(self):
+        # One connection per process, since connections must not cross a fork
+        key = (os.getpid(), self.filename)
+        if key not in _connections:
+            queue_dir = os.path.dirname(self.filename)
+            if queue_dir and not os.path.exists(queue_dir):
+                os.makedirs(queue_dir)
+            connection = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                aoi TEXT, scene_id TEXT, state TEXT, feature TEXT, clip_url TEXT, download_url TEXT, scene_path TEXT,
+                attempts INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, error TEXT, next_attempt REAL DEFAULT 0,
+                owner TEXT, claimed_at REAL, updated REAL, submitted_at REAL, PRIMARY KEY (aoi, scene_id))""")
+            # Queues created before clip deadlines were tracked
+            if 'submitted_at' not in [c[1] for c in connection.execute("PRAGMA table_info(jobs)")]:
+                connection.execute("ALTER TABLE jobs ADD COLUMN submitted_at REAL")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (aoi, failed, next_attempt)")
+            _connections[key] = connection
+        return _connections[key]
+
+    def enqueue(self, aoi, features, state=SEARCHED):
+        # Adds scenes that are not queued yet; queued scenes keep their state.
+        # Returns the number added
+        connection = self.connection
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO jobs (aoi, scene_id, state, feature, updated) VALUES (?, ?, ?, ?, ?)",
+                                   [(aoi, f['id'], state, json.dumps(f), now) for f in features])
+            added = connection.total_changes - before
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, aoi, owner, states=STATES[:-2], lease=LEASE):
+        # The due job in one of states that has waited longest, marked as
+        # owned by owner, or None
+        connection = self.connection
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("""SELECT * FROM jobs WHERE aoi = ? AND failed = 0 AND next_attempt <= ?
+                AND (owner IS NULL OR claimed_at < ?) AND state IN ({}) ORDER BY next_attempt, updated LIMIT 1""".format(','.join('?' * len(states))),
+                [aoi, now, now - lease] + list(states)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET owner = ?, claimed_at = ? WHERE aoi = ? AND scene_id = ?", (owner, now, aoi, row['scene_id']))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        job = dict(row)
+        job['feature'] = json.loads(job['feature'])
+        job.update(owner=owner, claimed_at=now)
+        return job
+
+    def _release(self, job, **fields):
+        fields.update(owner=None, claimed_at=None, updated=time.time())
+        assignments = ', '.join([k + ' = ?' for k in fields])
+        self.connection.execute("UPDATE jobs SET " + assignments + " WHERE aoi = ? AND scene_id = ? AND owner = ?",
+                                list(fields.values()) + [job['aoi'], job['scene_id'], job['owner']])
+
+    def advance(self, job, state, keep_attempts=False, **fields):
+        # Records a completed step (plus any URLs/paths it produced). Steps
+        # that a later failure falls back to keep the attempt count, so a
+        # failing chain of steps still runs out of attempts
+        attempts = job['attempts'] if keep_attempts else 0
+        self._release(job, state=state, attempts=attempts, error=None, next_attempt=0, **fields)
+
+    def defer(self, job, delay):
+        # Returns the job unchanged to be tried again after delay seconds,
+        # e.g. while a clip job is still running
+        self._release(job, next_attempt=time.time() + delay)
+
+    def fail(self, job, error, state=None, max_attempts=None, backoff=None):
+        # Schedules a retry with exponential backoff, optionally from an
+        # earlier state; after max_attempts the job is marked failed
+        max_attempts = max_attempts or self.max_attempts
+        backoff = self.backoff if backoff is None else backoff
+        attempts = job['attempts'] + 1
+        self._release(job, state=state or job['state'], attempts=attempts, error=str(error),
+                      failed=int(attempts >= max_attempts), next_attempt=time.time() + backoff * 2**(attempts - 1))
+
+    def retry_failed(self, aoi):
+        cursor = self.connection.execute("UPDATE jobs SET failed = 0, attempts = 0, next_attempt = 0 WHERE aoi = ? AND failed = 1", (aoi,))
+        return cursor.rowcount
+
+    def next_due(self, aoi, states=STATES[:-2]):
+        # Earliest time a pending job in states may be tried, or None if
+        # there are no pending jobs left
+        row = self.connection.execute("SELECT MIN(MAX(next_attempt, COALESCE(claimed_at + ?, 0))) FROM jobs WHERE aoi = ? AND failed = 0 AND state IN ({})".format(
+            ','.join('?' * len(states))), [LEASE, aoi] + list(states)).fetchone()
+        return row[0]
+
+    def counts(self, aoi):
+        # Number of jobs per state, with failed jobs counted separately
+        counts = {s : 0 for s in STATES + ['failed']}
+        for state, failed, n in self.connection.execute("SELECT state, failed, COUNT(*) FROM jobs WHERE aoi = ? GROUP BY state, failed", (aoi,)):
+            counts['failed' if failed else state] += n
+        return counts
+
+    def failed_jobs(self, aoi):
+        return [dict(row) for row in self.connection.execute("SELECT scene_id, state, attempts, error FROM jobs WHERE aoi = ? AND failed = 1", (aoi,))]
+
+def run_scene_job(queue, job, aoi_polygon, results_dir, poll_interval=POLL_INTERVAL, clip_timeout=CLIP_TIMEOUT, clips_url=None):
+    # Runs the next step of one scene's job and records the outcome, so
+    # each step is done once even across interrupted runs
+    from pl_utils import CLIPS_URL, check_clip, download_clip, submit_clip
+    scene_id = job['scene_id']
+    state = job['state']
+    fallback = None
+    try:
+        if state == SEARCHED:
+            queue.advance(job, CLIP_SUBMITTED, keep_attempts=True, clip_url=submit_clip(scene_id, aoi_polygon, clips_url or CLIPS_URL), submitted_at=time.time())
+        elif state == CLIP_SUBMITTED:
+            # A failed or stalled clip job is resubmitted on the next attempt
+            fallback = SEARCHED
+            download_url = check_clip(job['clip_url'])
+            if download_url:
+                queue.advance(job, CLIPPED, keep_attempts=True, download_url=download_url)
+            elif time.time() - (job['submitted_at'] or job['updated']) > clip_timeout:
+                raise RuntimeError("Clip job timed out after {:.0f} s".format(clip_timeout))
+            else:
+                queue.defer(job, poll_interval)
+        elif state == CLIPPED:
+            # Download links expire, so a failed download fetches a fresh one
+            fallback = CLIP_SUBMITTED
+            queue.advance(job, DOWNLOADED, scene_path=download_clip(job['download_url'], scene_id, results_dir))
+        elif state == DOWNLOADED:
+            from ndvi import plot_scene
+            print("Processing image acquired on " + job['feature']['properties']['acquired'])
+            plot_scene(job['scene_path'], scene_id, aoi_polygon, results_dir)
+            queue.advance(job, PROCESSED)
+        elif state == PROCESSED:
+            from ndvi import publish_scene
+            publish_scene(scene_id, job['aoi'], results_dir)
+            queue.advance(job, PUBLISHED)
+    except Exception as e:
+        # Any error is retried with backoff rather than ending the worker
+        print("Error: " + str(e))
+        print("Failed to " + {SEARCHED : 'clip', CLIP_SUBMITTED : 'clip', CLIPPED : 'download', DOWNLOADED : 'process', PROCESSED : 'publish'}[state] + " " + scene_id)
+        queue.fail(job, e, fallback)
+
+def _scene_job_worker(args):
+    # Returns the Planet request metrics of the steps it ran
+    from pl_utils import client_metrics
+    queue_filename, max_attempts, backoff, aoi, aoi_polygon, results_dir, states, options = args
+    queue = JobQueue(queue_filename, max_attempts, backoff)
+    owner = '{}:{:d}'.format(socket.gethostname(), os.getpid())
+    while True:
+        job = queue.claim(aoi, owner, states)
+        if job:
+            run_scene_job(queue, job, aoi_polygon, results_dir, **options)
+            continue
+        # Jobs other workers hold count as due when their lease lapses, so
+        # idle workers check back every poll_interval for released jobs
+        due = queue.next_due(aoi, states)
+        if due is None:
+            break
+        time.sleep(min(max(due - time.time(), 0.5), options['poll_interval']))
+    return client_metrics()
+
+def run_scene_jobs(queue, aoi, aoi_polygon, results_dir, n_workers=JOB_WORKERS, process=True, publish=False,
+                   poll_interval=POLL_INTERVAL, clip_timeout=CLIP_TIMEOUT, clips_url=None):
+    # Works through the AOI's queued scenes with n_workers processes until
+    # every job is done or has failed for good; returns the job counts.
+    # Jobs stop once downloaded if process is False, and after processing
+    # unless publish is True. Workers' stage timings and request metrics
+    # are merged into this process's report and Planet client
+    from pl_utils import get_client
+    if not process:
+        states = STATES[:STATES.index(DOWNLOADED)]
+    else:
+        states = STATES[:-1] if publish else STATES[:-2]
+    options = {'poll_interval' : poll_interval, 'clip_timeout' : clip_timeout, 'clips_url' : clips_url}
+    tasks = [(queue.filename, queue.max_attempts, queue.backoff, aoi, aoi_polygon, results_dir, states, options)] * n_workers
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            for metrics in [merge_worker_result(r) for r in pool.map(WorkerTask(_scene_job_worker), tasks)]:
+                get_client().merge_metrics(metrics)
+    else:
+        _scene_job_worker(tasks[0])
+    return queue.counts(aoi)
@@ -0,0 +1,98 @@
+"""
+Parsed PlanetScope scene metadata, cached in-process and in an on-disk index
+"""
+
+import os, re
+import copy, json, sqlite3
+
+from functools import lru_cache
+from xml.etree.ElementTree import iterparse
+
+from settings import METADATA_INDEX
+
+SCENE_ID_PATTERN = re.compile(r'^(\d{8}_\d{6}(?:_\d+)?_[0-9a-f]{4})')
+
+_connections = {}
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def parse_scene_metadata(metadata_filename):
+    # Single streaming pass over the XML; elements are cleared as soon as
+    # they are consumed so memory stays flat regardless of document size
+    record = {
+        'scene_id' : None,
+        'acquired' : None,
+        'footprint' : None,
+        'coefficients' : {}
+    }
+    band = {}
+
+    for event, elem in iterparse(metadata_filename, events=('end',)):
+        tag = _localname(elem.tag)
+        if tag == 'identifier' and record['scene_id'] is None:
+            record['scene_id'] = elem.text.strip()
+        elif tag == 'acquisitionDateTime' or tag == 'acquisitionDate':
+            if record['acquired'] is None:
+                record['acquired'] = elem.text.strip()
+        elif tag == 'coordinates' and record['footprint'] is None:
+            record['footprint'] = [[float(v) for v in p.split(',')[0:2]] for p in elem.text.split()]
+        elif tag == 'bandNumber':
+            band['number'] = elem.text.strip()
+        elif tag == 'reflectanceCoefficient':
+            band['coefficient'] = float(elem.text)
+        elif tag == 'bandSpecificMetadata':
+            if band.get('number') in ['1', '2', '3', '4'] and 'coefficient' in band:
+                record['coefficients'][int(band['number'])] = band['coefficient']
+            band = {}
+            elem.clear()
+
+    return record
+
+def scene_id_from_filename(filename):
+    match = SCENE_ID_PATTERN.match(os.path.basename(filename))
+    if match:
+        return match.group(1)
+    return os.path.abspath(filename)
+
+def _get_index(index_filename):
+    # One connection per process, since connections must not cross a fork
+    key = (os.getpid(), index_filename)
+    if key not in _connections:
+        index_dir = os.path.dirname(index_filename)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        connection = sqlite3.connect(index_filename, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS scenes (scene_id TEXT PRIMARY KEY, path TEXT, mtime REAL, size INTEGER, record TEXT)")
+        connection.commit()
+        _connections[key] = connection
+    return _connections[key]
+
+def _decode(record):
+    record = json.loads(record)
+    record['coefficients'] = {int(k) : v for k, v in record['coefficients'].items()}
+    return record
+
+@lru_cache(maxsize=1024)
+def _read_scene_metadata(path, mtime, size, index_filename):
+    scene_id = scene_id_from_filename(path)
+    connection = _get_index(index_filename)
+    row = connection.execute("SELECT mtime, size, record FROM scenes WHERE scene_id = ?", (scene_id,)).fetchone()
+    if row and row[0] == mtime and row[1] == size:
+        return _decode(row[2])
+
+    record = parse_scene_metadata(path)
+    connection.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?)", (scene_id, path, mtime, size, json.dumps(record)))
+    connection.commit()
+    return record
+
+def read_scene_metadata(metadata_filename, index_filename=METADATA_INDEX):
+    # Cached records are keyed on file size and mtime, so a re-downloaded
+    # scene is re-parsed rather than served stale. The cached record is
+    # shared, so callers get their own copy to modify
+    path = os.path.abspath(metadata_filename)
+    stat = os.stat(path)
+    return copy.deepcopy(_read_scene_metadata(path, stat.st_mtime, stat.st_size, index_filename))
+
+def get_reflectance_coefficients(metadata_filename):
+    return read_scene_metadata(metadata_filename)['coefficients']
@@ -1,91 +1,382 @@
-import os, sys
-from shutil import rmtree
+import os, uuid
 import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-
-from skimage.io import imread
-import json, requests, time, zipfile
+import json, time
 
 from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+# Planet, S3, shapefile and plotting modules are imported by the functions
+# that use them, so importing ndvi for computation stays cheap
+from settings import PL_AOIS, N_WORKERS
+from datacube import open_cube, scale_ndvi, SCALE as NDVI_SCALE, NODATA as NDVI_NODATA
+from instrument import WorkerTask, merge_worker_result, stage, start_report, timed
+from jobs import JobQueue, PROCESSED, run_scene_jobs
+from metadata import get_reflectance_coefficients
+from quality import assess_scene_quality, read_udm_mask
+from render import render_colorbar, render_image_png, render_ndvi_png
+from stats import StreamingStats, ZonalStats
+from timeseries import TimeseriesStore, COLUMNS as TIMESERIES_COLUMNS, MAX_PARTS as TIMESERIES_MAX_PARTS
+
+np.seterr(divide='ignore', invalid='ignore')
+
+def ndvi_windows(src, window=None, max_pixels=2**20):
+    # Native blocks (clipped to window) are used as-is for tiled rasters; for
+    # striped rasters (one or a few rows per block) consecutive strips are
+    # merged so each read covers roughly max_pixels
+    if window is None:
+        window = Window(0, 0, src.width, src.height)
+    col0, row0 = int(window.col_off), int(window.row_off)
+    col1, row1 = col0 + int(window.width), row0 + int(window.height)
+
+    block_height, block_width = src.block_shapes[0]
+    if block_width >= src.width:
+        block_height = max(block_height, (max_pixels // (col1 - col0)) // block_height * block_height)
+        block_width = col1 - col0
+        col_start = col0
+    else:
+        col_start = col0 - col0 % block_width
+
+    for row in range(row0 - row0 % block_height, row1, block_height):
+        for col in range(col_start, col1, block_width):
+            r, c = max(row, row0), max(col, col0)
+            yield Window(c, r, min(col + block_width, col1) - c, min(row + block_height, row1) - r)
+
+def iter_ndvi_blocks(src, coeff, window=None, outside=None, red_band=3, nir_band=4):
+    # Buffers are allocated once per distinct block shape (interior and
+    # edge blocks) and reused, so the yielded array is only valid until the
+    # next iteration. Yielded windows are relative to window; outside is an
+    # optional mask over window of pixels to set to NaN
+    buffers = {}
+    nodata = src.nodatavals[red_band - 1]
+    red_coeff = np.float32(coeff[red_band])
+    nir_coeff = np.float32(coeff[nir_band])
+    col0, row0 = (0, 0) if window is None else (int(window.col_off), int(window.row_off))
+
+    for block in ndvi_windows(src, window):
+        shape = (int(block.height), int(block.width))
+        if shape not in buffers:
+            buffers[shape] = (np.empty((2,) + shape, dtype=src.dtypes[red_band - 1]),
+                              np.empty(shape, dtype=np.float32),
+                              np.empty(shape, dtype=np.float32),
+                              np.empty(shape, dtype=np.float32),
+                              np.empty(shape, dtype=bool))
+        bands, red, nir, ndvi, invalid = buffers[shape]
+        relative = Window(block.col_off - col0, block.row_off - row0, block.width, block.height)
+
+        src.read([red_band, nir_band], window=block, out=bands)
+        if nodata is None:
+            np.logical_and(bands[0] == 0, bands[1] == 0, out=invalid)
+        else:
+            np.logical_or(bands[0] == nodata, bands[1] == nodata, out=invalid)
+        if outside is not None:
+            np.logical_or(invalid, outside[relative.toslices()], out=invalid)
+
+        np.multiply(bands[0], red_coeff, out=red)
+        np.multiply(bands[1], nir_coeff, out=nir)
+        np.subtract(nir, red, out=ndvi)
+        np.add(nir, red, out=nir)
+        np.divide(ndvi, nir, out=ndvi)
+        ndvi[invalid] = np.nan
+
+        yield relative, ndvi
+
+def ndvi_profile(profile, height, width, transform, dtype='float32', compress='deflate', blocksize=256):
+    profile = profile.copy()
+    profile.pop('photometric', None)
+    profile.update(driver='GTiff', count=1, height=height, width=width, transform=transform, interleave='band',
+                   tiled=True, blockxsize=blocksize, blockysize=blocksize, compress=compress, BIGTIFF='IF_SAFER')
+    if dtype == 'int16':
+        profile.update(dtype=rasterio.int16, nodata=NDVI_NODATA, predictor=2)
+    else:
+        profile.update(dtype=rasterio.float32, nodata=np.nan, predictor=3)
+    return profile
+
+def write_ndvi_tiff(src, coeff, out_filename, height, width, transform, window=None, outside=None,
+                    dtype='float32', compress='deflate', blocksize=256, overviews=True, cog=True):
+    # Streams NDVI blocks into a tiled, compressed GeoTIFF as float32 or as
+    # int16 scaled by NDVI_SCALE, with averaged internal overviews and
+    # (with cog) a Cloud-Optimized layout. Output is written under a unique
+    # temporary name and renamed, so concurrent workers never clobber or
+    # read a partial file
+    profile = ndvi_profile(src.profile, height, width, transform, dtype, compress, blocksize)
+    tmp_filename = '{}.{}.tmp'.format(out_filename, uuid.uuid4().hex[0:8])
+
+    with rasterio.open(tmp_filename, 'w', **profile) as dst:
+        if dtype == 'int16':
+            dst.scales = (NDVI_SCALE,)
+        for block, ndvi in iter_ndvi_blocks(src, coeff, window, outside):
+            dst.write(scale_ndvi(ndvi) if dtype == 'int16' else ndvi, 1, window=block)
+
+        factors = []
+        while overviews and max(height, width) / 2**(len(factors) + 1) >= blocksize / 2:
+            factors.append(2**(len(factors) + 1))
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+    if cog:
+        # Rewrite with the overviews and tile index ahead of the image data
+        cog_filename = tmp_filename + '.cog'
+        rasterio.shutil.copy(tmp_filename, cog_filename, driver='GTiff', copy_src_overviews=True, tiled=True,
+                             blockxsize=blocksize, blockysize=blocksize, compress=compress,
+                             predictor=profile['predictor'], BIGTIFF='IF_SAFER')
+        os.remove(tmp_filename)
+        tmp_filename = cog_filename
+    os.replace(tmp_filename, out_filename)
+
+    return out_filename
+
+@timed('ndvi')
+def calculate_ndvi(filename, metadata_filename, out_filename=None, shapefile=None, **tiff_options):
+    # With a shapefile, only the polygons' bounding window is read and
+    # pixels outside the polygons are NaN. With out_filename, NDVI is
+    # written there (see write_ndvi_tiff for options) instead of returned
+    from utils import get_shapefile_window_and_mask
+    coeff = get_reflectance_coefficients(metadata_filename)
 
-from xml.dom import minidom
+    with rasterio.open(filename) as src:
+        window, outside = None, None
+        if shapefile:
+            window, outside = get_shapefile_window_and_mask(src, shapefile)
+            height, width = outside.shape
+            transform = src.window_transform(window)
+        else:
+            height, width = src.height, src.width
+            transform = src.transform
 
-from requests.exceptions import ConnectionError
+        if out_filename:
+            return write_ndvi_tiff(src, coeff, out_filename, height, width, transform, window, outside, **tiff_options)
 
-from settings import PL_AOIS, PL_API_KEY
-from pl_utils import * 
-from s3utils import *
-from utils import * 
+        result = np.empty((height, width), dtype=np.float32)
+        for block, ndvi in iter_ndvi_blocks(src, coeff, window, outside):
+            result[block.toslices()] = ndvi
 
-np.seterr(divide='ignore', invalid='ignore')
+    return result
 
-def calculate_ndvi(filename, metadata_filename):
-    with rasterio.open(filename) as src:
-        band_red = src.read(3)
+@timed('stats')
+def calculate_ndvi_stats(filename, metadata_filename, shapefile=None):
+    # Statistics of the (clipped) NDVI accumulated block by block, without
+    # materializing the NDVI array
+    from utils import get_shapefile_window_and_mask
+    coeff = get_reflectance_coefficients(metadata_filename)
+    stats = StreamingStats()
 
     with rasterio.open(filename) as src:
-        band_nir = src.read(4)
-
-    xmldoc = minidom.parse(metadata_filename)
-    nodes = xmldoc.getElementsByTagName("ps:bandSpecificMetadata")
-
-    coeff = {}
-    for node in nodes:
-        band_num = node.getElementsByTagName("ps:bandNumber")[0].firstChild.data
-        if band_num in ['1', '2', '3', '4']:
-            i = int(band_num)
-            value = node.getElementsByTagName("ps:reflectanceCoefficient")[0].firstChild.data
-            coeff[i] = float(value)
-
-    band_red = band_red*coeff[3]
-    band_nir = band_nir*coeff[4]
-
-    ndvi = (band_nir.astype(float) - band_red.astype(float)) / (band_nir + band_red)
-    #mask = np.where(np.logical_and(band_nir == 0, band_red == 0))
-    #ndvi[mask] = np.nan
-
-    return ndvi
-
-def calculate_ndvi_timeseries(shape_file, images_dir):
-    dates = []
-    mean = []
-    sd = []
-
-    for f in os.listdir(images_dir):
-        for temp in os.listdir(images_dir + f):
-            if 'AnalyticMS_clip.tif' in temp:
-                tiff_file = temp 
-            if 'metadata' in temp:
-                metadata_file = temp 
-
-        image = load_image(images_dir + f + '/' + tiff_file, images_dir + f + '/' + metadata_file)
-        if quality_check(image):
-            dates.append(datetime.strptime(tiff_file[0:15], "%Y%m%d_%H%M%S"))
-            fn = clip_tiff_by_shapefile(images_dir + f + '/' + tiff_file, shape_file)
-            ndvi = calculate_ndvi(fn, images_dir + f + '/' + metadata_file)
-            mean.append(np.nanmean(ndvi))
-            sd.append(np.nanstd(ndvi))
-            os.remove(fn)
-        else:
-            print(tiff_file + " failed quality check!")
+        window, outside = None, None
+        if shapefile:
+            window, outside = get_shapefile_window_and_mask(src, shapefile)
+        for block, ndvi in iter_ndvi_blocks(src, coeff, window, outside):
+            stats.update(ndvi)
 
-    data = pd.DataFrame(data={'m' : mean, 'sd' : sd}, index=dates)
-    pd.to_pickle(data, images_dir + '../timeseries.pk')
+    return stats
+
+@timed('stats')
+def calculate_zonal_stats(filename, metadata_filename, shapefile, field=None):
+    # Per-feature NDVI statistics for every feature of shapefile in one pass
+    # over the features' bounding window. Features are named by field (or FID)
+    from utils import get_shapefile_zones
+    coeff = get_reflectance_coefficients(metadata_filename)
+
+    with rasterio.open(filename) as src:
+        window, labels, names = get_shapefile_zones(src, shapefile, field)
+        stats = ZonalStats(len(names))
+        for block, ndvi in iter_ndvi_blocks(src, coeff, window):
+            stats.update(labels[block.toslices()], ndvi)
+
+    return stats.records(list(names))
+
+def list_scene_dirs(images_dir):
+    # Skips partial downloads (.zip/.part files and hidden extraction dirs)
+    return [f for f in sorted(os.listdir(images_dir)) if not f.startswith('.') and os.path.isdir(images_dir + f)]
+
+def scene_datetime(filename):
+    return datetime.strptime(os.path.basename(filename)[0:15], "%Y%m%d_%H%M%S")
+
+def find_scene_files(scene_dir):
+    tiff_file = None
+    metadata_file = None
+    for temp in os.listdir(scene_dir):
+        if 'AnalyticMS_clip.tif' in temp:
+            tiff_file = os.path.join(scene_dir, temp)
+        if 'metadata' in temp:
+            metadata_file = os.path.join(scene_dir, temp)
+
+    return tiff_file, metadata_file
+
+def find_udm_file(scene_dir):
+    for temp in os.listdir(scene_dir):
+        if 'udm' in temp and temp.endswith('.tif'):
+            return os.path.join(scene_dir, temp)
+    return None
+
+def checked_scene_files(scene_dir):
+    # (tiff, metadata) of a scene that passes quality checks, else (None, None)
+    tiff_file, metadata_file = find_scene_files(scene_dir)
+    if not tiff_file or not metadata_file:
+        print(scene_dir + " is missing scene files!")
+        return None, None
+
+    qa = assess_scene_quality(tiff_file, find_udm_file(scene_dir))
+    if not qa['passed']:
+        print(os.path.basename(tiff_file) + " failed quality check! ({blank:.2f} blank, {cloud:.2f} cloud, {suspect:.2f} suspect)".format(**qa))
+        return None, None
+
+    return tiff_file, metadata_file
+
+def calculate_scene_stats(args):
+    # Runs in pool workers, so takes a single picklable argument and returns
+    # a small record instead of the NDVI array
+    scene_dir, shape_file = args
+    tiff_file, metadata_file = checked_scene_files(scene_dir)
+    if not tiff_file:
+        return None
+
+    try:
+        stats = calculate_ndvi_stats(tiff_file, metadata_file, shapefile=shape_file)
+    except ValueError as e:
+        print("Error: " + str(e))
+        return None
+
+    if stats.count == 0:
+        print(os.path.basename(tiff_file) + " has no valid pixels in AOI!")
+        return None
+
+    record = stats.record()
+    record['date'] = scene_datetime(tiff_file)
+    record['scene'] = os.path.basename(scene_dir)
+    return record
+
+def map_scenes(func, tasks, n_workers=N_WORKERS):
+    # func's result for each task, in task order, from n_workers processes;
+    # stages timed in the workers are added to this process's report
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            return [merge_worker_result(r) for r in pool.imap(WorkerTask(func), tasks)]
+    else:
+        return [func(task) for task in tasks]
+
+def calculate_scene_records(tasks, n_workers=N_WORKERS):
+    # One record (or None for rejected scenes) per task, in task order
+    return map_scenes(calculate_scene_stats, tasks, n_workers)
+
+def records_to_timeseries(records):
+    records = sorted([r for r in records if r], key=lambda r: r['date'])
+    dates = [r.pop('date') for r in records]
+
+    return pd.DataFrame(records, index=pd.DatetimeIndex(dates, name='date'), columns=TIMESERIES_COLUMNS)
+
+def calculate_scene_zonal_stats(args):
+    scene_dir, shape_file, field = args
+    tiff_file, metadata_file = checked_scene_files(scene_dir)
+    if not tiff_file:
+        return []
+
+    try:
+        records = calculate_zonal_stats(tiff_file, metadata_file, shape_file, field)
+    except ValueError as e:
+        print("Error: " + str(e))
+        return []
+
+    date = scene_datetime(tiff_file)
+    for record in records:
+        record['date'] = date
+        record['scene'] = os.path.basename(scene_dir)
+    return [r for r in records if r['count'] > 0]
+
+def calculate_zonal_timeseries(shape_file, images_dir, field=None, n_workers=N_WORKERS):
+    # Long-format per-zone timeseries indexed by (date, zone), for
+    # shapefiles of survey plots or other sub-areas of an AOI
+    tasks = [(images_dir + f, shape_file, field) for f in list_scene_dirs(images_dir)]
+    results = map_scenes(calculate_scene_zonal_stats, tasks, n_workers)
+
+    records = [r for result in results for r in result]
+    columns = ['date', 'zone'] + [c for c in TIMESERIES_COLUMNS if c != 'hist']
+    return pd.DataFrame(records, columns=columns).set_index(['date', 'zone']).sort_index()
+
+def calculate_ndvi_timeseries(shape_file, images_dir, n_workers=N_WORKERS):
+    tasks = [(images_dir + f, shape_file) for f in list_scene_dirs(images_dir)]
+    data = records_to_timeseries(calculate_scene_records(tasks, n_workers))
+
+    store = get_timeseries_store(images_dir + '../')
+    store.append(data)
+    store.compact()
 
     return data
 
-def update_ndvi_timeseries(data, results_dir):
+def get_timeseries_store(results_dir):
+    # Migrates a legacy timeseries.pk into the store the first time it is opened
+    store = TimeseriesStore(results_dir + 'timeseries/')
     if os.path.exists(results_dir + 'timeseries.pk'):
-        old_data = pd.read_pickle(results_dir + 'timeseries.pk')
-        data = old_data.append(data)
-        data = data.drop_duplicates()
-        data.to_pickle(results_dir + 'timeseries.pk')
-    else:
-        data.to_pickle(results_dir + 'timeseries.pk')
+        if store.read().empty:
+            store.import_pickle(results_dir + 'timeseries.pk')
+        os.rename(results_dir + 'timeseries.pk', results_dir + 'timeseries.pk.migrated')
+    return store
 
-def download_and_plot_scene(feature, results_dir):
+def update_ndvi_timeseries(data, results_dir):
+    # Appends only the new rows; recomputed scenes replace older values for
+    # the same acquisition datetime when the store is read. Years that have
+    # gathered MAX_PARTS parts from daily appends are compacted
+    store = get_timeseries_store(results_dir)
+    store.append(data)
+    store.compact(max_parts=TIMESERIES_MAX_PARTS)
+
+    return store.read()
+
+def file_fingerprint(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+def scene_fingerprint(scene_dir):
+    tiff_file, metadata_file = find_scene_files(scene_dir)
+    if not tiff_file or not metadata_file:
+        return None
+    return [file_fingerprint(tiff_file), file_fingerprint(metadata_file)]
+
+def load_manifest(results_dir):
+    if os.path.exists(results_dir + 'manifest.json'):
+        with open(results_dir + 'manifest.json', 'r') as f:
+            return json.load(f)
+    return {'shapefile' : None, 'scenes' : {}}
+
+def save_manifest(manifest, results_dir):
+    # Write then rename so an interrupted run never leaves a truncated manifest
+    with open(results_dir + 'manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(results_dir + 'manifest.json.tmp', results_dir + 'manifest.json')
+
+def update_ndvi_timeseries_incremental(shape_file, results_dir, n_workers=N_WORKERS):
+    # Only scenes that are new, or whose files changed since they were last
+    # processed, are computed; a changed shapefile invalidates everything
+    images_dir = results_dir + 'data/'
+    manifest = load_manifest(results_dir)
+    shape_fingerprint = [os.path.abspath(shape_file)] + file_fingerprint(shape_file)
+    if manifest['shapefile'] != shape_fingerprint:
+        manifest = {'shapefile' : shape_fingerprint, 'scenes' : {}}
+
+    tasks = []
+    fingerprints = []
+    for f in list_scene_dirs(images_dir):
+        fingerprint = scene_fingerprint(images_dir + f)
+        if fingerprint and manifest['scenes'].get(f) != fingerprint:
+            tasks.append((images_dir + f, shape_file))
+            fingerprints.append((f, fingerprint))
+
+    print("Calculating NDVI for {:d} new scenes...".format(len(tasks)))
+    records = calculate_scene_records(tasks, n_workers)
+    data = update_ndvi_timeseries(records_to_timeseries(records), results_dir)
+
+    for scene_id, fingerprint in fingerprints:
+        manifest['scenes'][scene_id] = fingerprint
+    save_manifest(manifest, results_dir)
+
+    return data
+
+def make_results_dirs(results_dir):
     if not os.path.exists(results_dir):
         os.mkdir(results_dir)
         os.mkdir(results_dir + 'npy/')
@@ -93,70 +384,50 @@ def download_and_plot_scene(feature, results_dir):
         os.mkdir(results_dir + 'data/')
         os.mkdir(results_dir + 'ts/')
 
-    scene_id = feature['id']
-    if scene_id not in os.listdir(results_dir + 'data/'):
-        date_string = feature['properties']['acquired'] 
-        print("Processing image acquired on " + date_string + " ({:d}/{:d})".format(i+1, n_scenes))
-        assets_url = feature['_links']['assets']
-        res = session.get(assets_url)
-        assets = res.json()
-        
-        scene = assets['analytic']
-        #print("Clipping scene to area of interest...")
-        clip_url = clip_asset(scene_id, aoi_polygon)
-        if clip_url:
-            #print("Downloading clipped scene data...")
-            scene_path = download_clip(clip_url, scene_id, results_dir)
-
-            files = sorted(os.listdir(scene_path))
-            scene_filename = os.path.join(scene_path, files[1])
-            metadata_filename = os.path.join(scene_path, files[2])
-            
-            #print("Saving image of scene...")
-            image = load_image(scene_filename, metadata_filename)
-            plot_image(image, scene_id) 
-
-            #print("Calculating NDVI...")
-            ndvi = calculate_ndvi(scene_filename, metadata_filename)
-            plot_ndvi(ndvi, scene_id, results_dir) 
-            
-            np.save(results_dir + 'npy/ndvi_' + scene_id + '.npy', ndvi)
-            np.save(results_dir + 'npy/img_' + scene_id + '.npy', image)
-
-def plot_image(image, label_string):
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
+def plot_scene(scene_path, scene_id, aoi_polygon, results_dir):
+    from utils import load_image
+    scene_filename, metadata_filename = find_scene_files(scene_path)
 
-    ax.imshow(image)
-    ax.axis('off')
-    ax.set_title(label_string, fontsize=12)
-    
+    #print("Saving image of scene...")
+    image = load_image(scene_filename, metadata_filename)
+    plot_image(image, scene_id, results_dir)
+
+    #print("Calculating NDVI...")
+    ndvi = calculate_ndvi(scene_filename, metadata_filename)
+    plot_ndvi(ndvi, scene_id, results_dir)
+
+    # Cloudy and blackfill pixels are left out of the cube, so mosaics and
+    # composites only draw on clear observations
+    udm_filename = find_udm_file(scene_path)
+    if udm_filename:
+        mask = read_udm_mask(udm_filename)
+        if mask.shape == ndvi.shape:
+            ndvi[mask] = np.nan
+
+    with stage('cube'), rasterio.open(scene_filename) as src:
+        cube = open_cube(results_dir + 'cube/', aoi_polygon, src.crs)
+        cube.append(ndvi, src.transform, src.crs, scene_datetime(scene_filename), scene_id)
+
+    np.save(results_dir + 'npy/img_' + scene_id + '.npy', image)
+
+@timed('plot')
+def plot_image(image, label_string, results_dir):
     filename = results_dir + 'img/img_' + label_string + '.png'
-    plt.savefig(filename, dpi=200, bbox_inches='tight', pad_inches=0.5)
-    plt.close()
+    render_image_png(image, filename, title=label_string)
     #save_file_to_s3(filename, filename)
 
+@timed('plot')
 def plot_ndvi(ndvi, label_string, results_dir):
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    vmin = -0.25
-    vmax = 0.75
-    mid = 0.1
-    
-    cmap = plt.cm.RdYlGn
-    cax = ax.imshow(ndvi, cmap=cmap, clim=(vmin, vmax), norm=MidpointNormalize(midpoint=mid, vmin=vmin, vmax=vmax))
-    ax.axis('off')
-    ax.set_title(label_string, fontsize=12)
-    cbar = fig.colorbar(cax, orientation='horizontal', shrink=0.5)
-    cbar.set_label('NDVI')
-    
+    # Map is written straight from the colormap LUT, with the cached title
+    # glyphs and colorbar pasted on; the colorbar is also saved on its own
     filename = results_dir + 'img/ndvi_' + label_string + '.png'
-    plt.savefig(filename, dpi=200, bbox_inches='tight', pad_inches=0.5)
-    plt.close()
+    render_ndvi_png(ndvi, filename, title=label_string)
+    render_colorbar(results_dir + 'img/ndvi_colorbar.png')
     #save_file_to_s3(filename, filename)
 
+@timed('plot')
 def plot_ndvi_timeseries(data, label_string, results_dir):
+    import matplotlib.pyplot as plt
     fig = plt.figure()
     ax = fig.add_subplot(111)
     
@@ -174,42 +445,44 @@ def plot_ndvi_timeseries(data, label_string, results_dir):
 def quality_check(img, thresh=0.25):
     # XXX: really crude quality check (for incomplete images with lots of blank space...)
     npixels = np.prod(img.shape[0:2])
-    nblanks = len(np.where(img == 0.0)[0]) / 3.
+    nblanks = np.count_nonzero(img == 0.0) / 3.
     if nblanks / npixels > thresh:
         return False
     else:
         return True
 
-def save_ndvi_tiff(filename, metadata_filename):
-    ndvi = calculate_ndvi(filename, metadata_filename)
-
-    with rasterio.open(filename) as data:
-        ndvi_raster = rasterio.open('ndvi.tif', 'w', driver=data.driver, height=data.height, width=data.width, count=1, dtype=rasterio.float64, crs=data.crs, transform=data.transform)
-        ndvi_raster.write(ndvi, 1)
-        ndvi_raster.close()
-
-def save_all_tiffs(images_dir):
-    for f in os.listdir(images_dir):
-        for temp in os.listdir(images_dir + f):
-            if 'clip.tif' in temp and 'udm' not in temp:
-                tiff_file = temp 
-            if 'metadata' in temp:
-                metadata_file = temp 
-        os.chdir(images_dir + f)
-        save_ndvi_tiff(tiff_file, metadata_file)
-        os.chdir('..')
+def save_ndvi_tiff(filename, metadata_filename, out_filename=None, **tiff_options):
+    # Defaults to <scene>_ndvi.tif next to the scene
+    if not out_filename:
+        out_filename = filename.replace('_AnalyticMS_clip.tif', '').replace('.tif', '') + '_ndvi.tif'
+    return calculate_ndvi(filename, metadata_filename, out_filename=out_filename, **tiff_options)
+
+def save_all_tiffs(images_dir, **tiff_options):
+    for f in list_scene_dirs(images_dir):
+        tiff_file, metadata_file = find_scene_files(images_dir + f)
+        if tiff_file and metadata_file:
+            save_ndvi_tiff(tiff_file, metadata_file, **tiff_options)
+
+def publish_scene(scene_id, aoi, results_dir):
+    from s3utils import upload_file_to_s3
+    for prefix in ['img_', 'ndvi_']:
+        filename = results_dir + 'img/' + prefix + scene_id + '.png'
+        if os.path.exists(filename):
+            upload_file_to_s3(filename, aoi + '/img/' + os.path.basename(filename), policy='public-read')
 
 if __name__ == "__main__":
-    URL = "https://api.planet.com/data/v1"
-    search_url = "{}/quick-search".format(URL)
-    session = requests.Session()
-    session.auth = (PL_API_KEY, "")
+    from catalog import search_catalog
+    from composite import update_composite
+    from pl_utils import get_client
+
+    client = get_client()
 
     aois = PL_AOIS  
     time_window_length = 365 / 2 # days
 
     for aoi in aois:
         print("Processing images for site: " + aoi.upper())
+        report = start_report(aoi)
         base_dir = '/media/rmsare/GALLIUMOS/ndvi/'
         results_dir = base_dir + aoi + '/'
         aoi_filename = 'polygons/' + aoi + '.json'
@@ -220,32 +493,33 @@ if __name__ == "__main__":
         datetime_max = datetime.utcnow() 
         datetime_min = datetime.utcnow() - timedelta(days=time_window_length)
         
-        item_types = ["PSScene4Band"]
-        and_filter = configure_filter(aoi_polygon, datetime_min, datetime_max)
-
-        request = {
-            "name" : aoi,
-            "item_types" : item_types,
-            "interval" : "year",
-            "filter" : and_filter
-        }
-        
-        res = session.post(search_url, json=request)
-        geojson = res.json()
-        n_scenes = len(geojson['features'])
-        failed = []
-
-        print("Downloading assets...")
-        for i, feature in enumerate(geojson['features']):
-            try:
-                download_and_plot_scene(feature, results_dir)
-            except (ConnectionError, KeyError, ValueError) as e:
-                failed.append(feature)
-                print("Error: " + str(e))
-                print("Failed to process image acquired on " + feature['properties']['acquired'])
+        scenes = search_catalog(aoi, aoi_polygon, datetime_min, datetime_max)
+        make_results_dirs(results_dir)
+        # Scenes downloaded before the queue existed were processed then
+        downloaded = os.listdir(results_dir + 'data/')
+        queue = JobQueue()
+        queue.enqueue(aoi, [f for f in scenes if f['id'] in downloaded], state=PROCESSED)
+        queue.enqueue(aoi, [f for f in scenes if f['id'] not in downloaded])
+
+        print("Downloading and processing scenes...")
+        counts = run_scene_jobs(queue, aoi, aoi_polygon, results_dir)
+        print(", ".join(["{:d} {}".format(n, state) for state, n in counts.items() if n]))
+        for job in queue.failed_jobs(aoi):
+            print("Failed: {scene_id} ({state}, {attempts:d} attempts): {error}".format(**job))
 
         print("Calculating average NDVI timeseries...")
-        data = calculate_ndvi_timeseries(shape_filename, results_dir + 'data/')
+        data = update_ndvi_timeseries_incremental(shape_filename, results_dir)
         plot_ndvi_timeseries(data, aoi.upper(), results_dir)
-        update_ndvi_timeseries(data, results_dir)
+
+        if os.path.exists(results_dir + 'cube/cube.json'):
+            # Only days and months with new scenes are recomputed
+            print("Updating daily mosaics and monthly composites...")
+            with stage('composite'):
+                update_composite(results_dir + 'cube/', results_dir + 'mosaic/', 'day', 'mean')
+                update_composite(results_dir + 'mosaic/', results_dir + 'composite_monthly/', 'month', 'median')
+
+        report.print_summary()
+        report.write(results_dir + 'reports/')
+
+    client.print_metrics()
         
@@ -2,21 +2,140 @@
 Utilitie functions using the Planet APIs
 """
 
-import os, sys
-import rasterio
-import numpy as np
-import matplotlib.pyplot as plt
+import os
+import json, re, requests, time, zipfile
+import base64, hashlib
 
-from skimage.io import imread
-import json, requests, time, zipfile
+from collections import defaultdict
+from datetime import datetime
+from shutil import copyfileobj, rmtree
+from threading import Lock
+from urllib.parse import urlparse
 
-from settings import PL_API_KEY
-from utils import *
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from instrument import count_bytes, timed
+from settings import PL_API_KEY, PL_POOL_SIZE
+
+SEARCH_URL = 'https://api.planet.com/data/v1/quick-search'
+CLIPS_URL = 'https://api.planet.com/compute/ops/clips/v1'
+CLIP_MEMBERS = ['AnalyticMS_clip.tif', 'udm_clip.tif', 'metadata_clip.xml']
+CHUNK_SIZE = 1024*1024
+ID_PATTERN = re.compile(r'^(?=.*\d)[0-9a-zA-Z_-]{16,}$')
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+class PlanetClient(object):
+    """
+    Pooled keep-alive session for the Planet APIs, retrying rate-limited
+    (429) and server error responses to idempotent requests with exponential
+    backoff and recording request counts and time per endpoint. POSTs are
+    only retried on failed connections and on the statuses passed to post
+    """
+    def __init__(self, api_key=PL_API_KEY, pool_size=PL_POOL_SIZE, retries=5, backoff_factor=1, timeout=60):
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False, respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.auth = (api_key, '')
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.metrics = defaultdict(lambda: {'count' : 0, 'errors' : 0, 'seconds' : 0.0})
+        self._lock = Lock()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        error = False
+        try:
+            res = self.session.request(method, url, **kwargs)
+            error = res.status_code >= 400
+            return res
+        except requests.RequestException:
+            error = True
+            raise
+        finally:
+            self._record(method + ' ' + endpoint_name(url), time.time() - start, error)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, retry_statuses=(429,), **kwargs):
+        # A POST that reached the server may have acted (a resent clip order
+        # is a second clip job), so by default it is only resent when
+        # rejected with 429. Read-only POSTs such as searches can pass
+        # RETRY_STATUSES
+        for attempt in range(self.retries + 1):
+            res = self.request('POST', url, **kwargs)
+            if res.status_code not in retry_statuses or attempt == self.retries:
+                return res
+            time.sleep(retry_delay(res, self.backoff_factor * 2**attempt))
+
+    def _record(self, endpoint, seconds, error):
+        with self._lock:
+            self.metrics[endpoint]['count'] += 1
+            self.metrics[endpoint]['errors'] += int(error)
+            self.metrics[endpoint]['seconds'] += seconds
+
+    def merge_metrics(self, metrics):
+        # Adds request metrics recorded by another process's client
+        with self._lock:
+            for endpoint, other in metrics.items():
+                for k in ['count', 'errors', 'seconds']:
+                    self.metrics[endpoint][k] += other[k]
+
+    def print_metrics(self):
+        for endpoint, m in sorted(self.metrics.items()):
+            print("{}: {:d} requests, {:d} errors, {:.2f} s total, {:.3f} s mean".format(endpoint, m['count'], m['errors'], m['seconds'], m['seconds'] / m['count']))
+
+def retry_delay(res, default):
+    # Seconds asked for by a Retry-After header, else default
+    try:
+        return float(res.headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+def endpoint_name(url):
+    # Collapse job/item ids in the path so metrics aggregate per endpoint
+    parsed = urlparse(url)
+    path = '/'.join(['{id}' if ID_PATTERN.match(p) else p for p in parsed.path.split('/')])
+    return parsed.netloc + path
+
+_client = None
+_client_pid = None
+_client_kwargs = {}
+
+def get_client():
+    # Sessions must not be shared across a fork, so each process makes its own
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = PlanetClient(**_client_kwargs)
+        _client_pid = os.getpid()
+    return _client
+
+def client_metrics():
+    # Request metrics of this process's client, e.g. to send back from a
+    # pool worker to be merged with merge_metrics
+    if _client is None or _client_pid != os.getpid():
+        return {}
+    return {endpoint : dict(m) for endpoint, m in _client.metrics.items()}
+
+def configure_client(**kwargs):
+    global _client
+    _client_kwargs.clear()
+    _client_kwargs.update(kwargs)
+    _client = None
+    return get_client()
+
+@timed('activate')
 def activate_asset(asset):
     asset_url = asset['_links']['_self']
     activation_url = asset['_links']['activate']
-    res = session.get(activation_url)
+    res = get_client().get(activation_url)
 
     if res.status_code == 204:
         return 
@@ -27,7 +146,7 @@ def activate_asset(asset):
         timeout = 120 # s
         elapsed = 0
         while not activated and elapsed < timeout:
-            check_status = session.get(asset_url)
+            check_status = get_client().get(asset_url)
             if check_status.json()['status'] == 'active':
                 activated = True
             else:
@@ -39,7 +158,8 @@ def activate_asset(asset):
 
     return res.status_code
 
-def clip_asset(item_id, aoi_polygon):
+@timed('clip')
+def submit_clip(item_id, aoi_polygon, clips_url=CLIPS_URL):
     clip_payload = {
         'aoi' : aoi_polygon,
         'targets' : [
@@ -51,26 +171,25 @@ def clip_asset(item_id, aoi_polygon):
         ]
     }
 
-    request = requests.post('https://api.planet.com/compute/ops/clips/v1', auth=(PL_API_KEY, ''), json=clip_payload)
-    clip_url = request.json()['_links']['_self']
+    request = get_client().post(clips_url, json=clip_payload)
+    return request.json()['_links']['_self']
 
-    clip_succeeded = False
-    clip_download_url = None
-    timeout = 5*60 # s
-    elapsed = 0
-    while not clip_succeeded and elapsed < timeout:
-        check_state_request = requests.get(clip_url, auth=(PL_API_KEY, ''))
-        
-        if check_state_request.json()['state'] == 'succeeded':
-            clip_download_url = check_state_request.json()['_links']['results'][0]
-            clip_succeeded = True
-        else:
-            elapsed += 1
-            time.sleep(1)
-    if elapsed == timeout:
-        print("Clipping timed out!")
+@timed('clip')
+def check_clip(clip_url):
+    # Returns the download URL once the clip job has succeeded, else None
+    check_state_request = get_client().get(clip_url)
+    state = check_state_request.json()['state']
+    if state == 'succeeded':
+        return check_state_request.json()['_links']['results'][0]
+    if state == 'failed':
+        raise ValueError("Clip job " + clip_url + " failed")
+    return None
 
-    return clip_download_url
+def rfc3339(date_obj):
+    # XXX: Assumes date_obj is UTC +0
+    # TODO : TZ conversion
+    rfc_fmt = '%Y-%m-%dT%H:%M:%SZ'
+    return datetime.strftime(date_obj, rfc_fmt)
 
 def configure_filter(aoi_polygon, datetime_min, datetime_max):
     date_filter = {
@@ -105,29 +224,126 @@ def configure_filter(aoi_polygon, datetime_min, datetime_max):
 
     return and_filter
 
-def download_pl(url, filename=None):
-    res = requests.get(url, stream=True, auth=(PL_API_KEY, ""))
+def iter_search_pages(name, aoi_polygon, datetime_min, datetime_max, item_types=["PSScene4Band"], search_url=SEARCH_URL, page_size=250):
+    # Features of each result page, following _links._next until the last
+    and_filter = configure_filter(aoi_polygon, datetime_min, datetime_max)
+
+    request = {
+        "name" : name,
+        "item_types" : item_types,
+        "interval" : "year",
+        "filter" : and_filter
+    }
+
+    client = get_client()
+    res = client.post(search_url, json=request, params={'_page_size' : page_size}, retry_statuses=RETRY_STATUSES)
+    while True:
+        res.raise_for_status()
+        page = res.json()
+        yield page['features']
+        next_url = page.get('_links', {}).get('_next')
+        if not next_url or not page['features']:
+            break
+        res = client.get(next_url)
+
+@timed('search')
+def search_scenes(name, aoi_polygon, datetime_min, datetime_max, item_types=["PSScene4Band"], search_url=SEARCH_URL):
+    return [f for page in iter_search_pages(name, aoi_polygon, datetime_min, datetime_max, item_types, search_url) for f in page]
+
+def response_md5(res):
+    # Hex MD5 of the whole object, if the server reports one
+    for value in res.headers.get('x-goog-hash', '').split(','):
+        if value.strip().startswith('md5='):
+            return base64.b64decode(value.strip()[4:]).hex()
+    if res.status_code == 200 and 'Content-MD5' in res.headers:
+        return base64.b64decode(res.headers['Content-MD5']).hex()
+    return None
+
+@timed('download')
+def download_file(url, filename, chunk_size=CHUNK_SIZE, expected_md5=None):
+    # Downloads to filename + '.part' and renames on success, so an
+    # interrupted download resumes with an HTTP range request next time
+    part_filename = filename + '.part'
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    headers = {'Range' : 'bytes={:d}-'.format(offset)} if offset else {}
+    res = get_client().get(url, stream=True, headers=headers)
+    if res.status_code == 416:
+        os.remove(part_filename)
+        return download_file(url, filename, chunk_size, expected_md5)
+    res.raise_for_status()
+
+    md5 = hashlib.md5()
+    if res.status_code == 206:
+        mode = 'ab'
+        with open(part_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+    else:
+        mode = 'wb'
+        offset = 0
+
+    nbytes = 0
+    with open(part_filename, mode) as f:
+        for chunk in res.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            md5.update(chunk)
+            nbytes += len(chunk)
+    count_bytes('download', nbytes)
+
+    if 'Content-Length' in res.headers and nbytes != int(res.headers['Content-Length']):
+        raise ValueError("Incomplete download of " + url)
+    expected_md5 = expected_md5 or response_md5(res)
+    if expected_md5 and md5.hexdigest() != expected_md5:
+        os.remove(part_filename)
+        raise ValueError("Checksum mismatch for " + url)
+    os.replace(part_filename, filename)
 
+    return filename
+
+@timed('extract')
+def extract_members(zip_filename, out_dir, members=None, chunk_size=CHUNK_SIZE):
+    # Extracts members whose names contain one of the strings in members
+    # (all members if None) flat into out_dir. Files are written to a hidden
+    # temporary directory that is renamed into place once complete; an
+    # existing out_dir is moved aside first and removed after the swap
+    tmp_dir = os.path.join(os.path.dirname(out_dir), '.' + os.path.basename(out_dir))
+    if os.path.exists(tmp_dir):
+        rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+
+    with zipfile.ZipFile(zip_filename) as zipped:
+        for info in zipped.infolist():
+            name = os.path.basename(info.filename)
+            if not name or (members and not any(m in name for m in members)):
+                continue
+            with zipped.open(info) as src, open(os.path.join(tmp_dir, name), 'wb') as dst:
+                copyfileobj(src, dst, chunk_size)
+            count_bytes('extract', info.file_size)
+
+    if os.path.exists(out_dir):
+        old_dir = tmp_dir + '.old'
+        if os.path.exists(old_dir):
+            rmtree(old_dir)
+        os.rename(out_dir, old_dir)
+        os.rename(tmp_dir, out_dir)
+        rmtree(old_dir)
+    else:
+        os.rename(tmp_dir, out_dir)
+
+    return out_dir
+
+def download_pl(url, filename=None, chunk_size=CHUNK_SIZE):
     if not filename:
         filename = url.split('=')[1][:10]
     if not os.path.exists(filename):
-        with open(filename, 'wb') as f:
-            for chunk in res.iter_content(chunk_size=1024):
-                f.write(chunk)
-                f.flush()
+        download_file(url, filename, chunk_size)
 
     return filename
 
-def download_clip(url, scene_id, data_dir):
-    res = requests.get(url, stream=True, auth=(PL_API_KEY, ""))
-
-    with open(data_dir + 'data/' + scene_id + '.zip', 'wb') as f:
-        for data in res.iter_content(chunk_size=1024):
-            f.write(data)
-            f.flush()
-    
-    zipped = zipfile.ZipFile(data_dir + 'data/' + scene_id + '.zip')
-    zipped.extractall(data_dir + 'data/' + scene_id)
-    os.remove(data_dir + 'data/' + scene_id + '.zip')
+def download_clip(url, scene_id, data_dir, members=CLIP_MEMBERS, chunk_size=CHUNK_SIZE, expected_md5=None):
+    zip_filename = data_dir + 'data/' + scene_id + '.zip'
+    download_file(url, zip_filename, chunk_size, expected_md5)
+    extract_members(zip_filename, data_dir + 'data/' + scene_id, members, chunk_size)
+    os.remove(zip_filename)
 
     return data_dir + 'data/' + scene_id
@@ -1,92 +1,88 @@
 import os
 import numpy as np
-import rasterio
 import subprocess
 
-import matplotlib.colors as colors
-import matplotlib.pyplot as plt
-
-from datetime import datetime
-from shutil import copyfile
-from xml.dom import minidom
-
-from ndvi import *
-from utils import *
-
-def plot_ndvi(filename):
-    with rasterio.open(filename) as src:
-
-        ndvi = src.read(1)
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    vmin = -0.25
-    vmax = 0.75
-    mid = 0.1
-
-    cmap = plt.cm.RdYlGn
-    cax = ax.imshow(ndvi, cmap=cmap, clim=(vmin, vmax), norm=MidpointNormalize(midpoint=mid, vmin=vmin, vmax=vmax))
-    ax.axis('off')
-    plt.xlim(315, 580)
-    plt.ylim(295, 635)
-    ax.invert_yaxis()
-    
-    label_string = datetime.strptime(filename[5:20], '%Y%m%d_%H%M%S').strftime('%m/%d/%Y %H:%M')
-    ax.set_title(label_string, fontsize=18)
-    cbar = fig.colorbar(cax, orientation='horizontal', shrink=0.5)
-    cbar.set_label('NDVI', fontsize=14)
-
-    plt.savefig(filename[:-4] + '.png', dpi=200, bbox_inches='tight', pad_inches=0.1)
-    plt.close()
-
-def save_ndvi_tiff(filename, metadata_filename):
-    ndvi = calculate_ndvi(filename, metadata_filename)
-
-    with rasterio.open(filename) as data:
-        ndvi_raster = rasterio.open('ndvi.tif', 'w', driver=data.driver, height=data.height, width=data.width, count=1, dtype=rasterio.float64, crs=data.crs, transform=data.transform)
-        ndvi_raster.write(ndvi, 1)
-        ndvi_raster.close()
-
-def move_files_to_gif(aoi):
-    os.chdir(aoi)
-    if 'gif' not in os.listdir('.'):
-        os.mkdir('gif')
-    os.chdir('data/')
-    files = os.listdir('.')
-    for f in files: 
-        if 'ndvi_clip.tif' not in os.listdir(f):
-            os.chdir(f)
-            for g in os.listdir('.'):
-                if 'AnalyticMS_clip.tif' in g:
-                    img_file = g
-                if 'metadata' in g:
-                    metadata_file = g
-            save_ndvi_tiff(img_file, metadata_file)
-
-            tiff_file = 'ndvi.tif'
-            shapefile = 'shp/' + aoi + '.shp'
-            clip_tiff_by_shapefile(tiff_file, shapefile)
-            os.chdir('..')
-
-        timestamp = f[0:15]
-        fn = '../gif/ndvi_' + timestamp + '.tif'
-        if not os.path.exists(fn):
-            copyfile(f + '/ndvi_clip.tif', fn)
-    os.chdir('../..')
+from multiprocessing import Pool
+
+from datacube import NDVICube
+from render import decimate, label_image, ndvi_image, ndvi_to_index, title_height
+from settings import N_WORKERS
+
+class FFmpegWriter(object):
+    """
+    Pipes raw RGB frames to ffmpeg, which encodes them to H.264 as they arrive
+    """
+    def __init__(self, filename, width, height, fps=4):
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                   "-s", "{:d}x{:d}".format(width, height), "-r", str(fps), "-i", "-",
+                   "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", filename]
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write_frame(self, frame):
+        self.process.stdin.write(frame)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait():
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def render_animation_frame(args):
+    # Runs in pool workers: reads one cube frame and draws its date above
+    # it, as a palette image for GIFs or raw RGB bytes for ffmpeg
+    cube_root, i, title, max_size, fmt = args
+    image = label_image(ndvi_image(ndvi_to_index(decimate(NDVICube(cube_root).read_frame(i), max_size))), title)
+    if fmt == 'gif':
+        return image
+    return image.convert('RGB').tobytes()
+
+def make_ndvi_animation(cube_root, filename, max_size=512, fps=4, start=None, end=None, n_workers=N_WORKERS):
+    # Animates the AOI's NDVI cube in acquisition order, straight from the
+    # cube to a .gif or .mp4 without intermediate rasters or images
+    cube = NDVICube(cube_root)
+    times = cube.times
+    order = sorted([i for i, t in enumerate(times) if (start is None or t >= start) and (end is None or t <= end)], key=lambda i: times[i])
+    if not order:
+        print("No frames to animate in " + cube_root)
+        return None
+
+    fmt = 'mp4' if filename.endswith('.mp4') else 'gif'
+    tasks = [(cube_root, i, times[i].strftime('%m/%d/%Y %H:%M'), max_size, fmt) for i in order]
+
+    pool = Pool(n_workers) if n_workers > 1 else None
+    try:
+        frames = pool.imap(render_animation_frame, tasks) if pool else map(render_animation_frame, tasks)
+        if fmt == 'gif':
+            # Pillow pulls frames from the workers as it encodes them; the
+            # NODATA entry stays transparent and each frame clears the last
+            first = next(frames)
+            first.save(filename, 'GIF', save_all=True, append_images=frames, duration=1000. / fps, loop=0, disposal=2)
+        else:
+            step = max(int(np.ceil(max(cube.height, cube.width) / float(max_size))), 1)
+            height, width = (cube.height + step - 1) // step + title_height(), (cube.width + step - 1) // step
+            with FFmpegWriter(filename, width, height, fps) as writer:
+                for frame in frames:
+                    writer.write_frame(frame)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return filename
 
 if __name__ == "__main__":
     data_dir = '/media/rmsare/GALLIUMOS/ndvi/'
-    curdir = os.getcwd()
-    os.chdir(data_dir)
 
     aois = ['redsck', 'ssf', 'chair12', 'chair14']
     for aoi in aois:
         print("Processing site: {}".format(aoi.upper()))
-        move_files_to_gif(aoi)
-        os.chdir(aoi + '/gif/')
-        for f in os.listdir('.'):
-            fn = f[:-4] + '.png'
-            if not os.path.exists(fn):
-                plot_ndvi(f)
-    os.chdir(curdir)
+        gif_dir = data_dir + aoi + '/gif/'
+        if not os.path.exists(gif_dir):
+            os.mkdir(gif_dir)
+        make_ndvi_animation(data_dir + aoi + '/cube/', gif_dir + 'ndvi_' + aoi + '.gif')
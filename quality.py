@@ -0,0 +1,66 @@
+"""
+Scene quality assessment from Planet UDM masks or decimated band overviews
+"""
+
+import numpy as np
+import rasterio
+
+from rasterio.enums import Resampling
+
+from instrument import timed
+
+# Planet unusable data mask bits
+UDM_BLACKFILL = 1
+UDM_CLOUD = 2
+UDM_SUSPECT = 4 | 8 | 16 | 32 | 64
+
+def _read_decimated(src, indexes, decimation):
+    out_shape = (len(indexes), max(src.height // decimation, 1), max(src.width // decimation, 1))
+    return src.read(indexes, out_shape=out_shape, resampling=Resampling.nearest)
+
+def _fractions(codes, npixels):
+    # Single reduction over the per-pixel flag codes; the flag fractions are
+    # then sums over the (at most 256) distinct codes
+    counts = np.bincount(codes.ravel(), minlength=256)
+    values = np.arange(counts.size)
+    blank = counts[(values & UDM_BLACKFILL) != 0].sum() / npixels
+    cloud = counts[((values & UDM_CLOUD) != 0) & ((values & UDM_BLACKFILL) == 0)].sum() / npixels
+    suspect = counts[((values & UDM_SUSPECT) != 0) & ((values & UDM_BLACKFILL) == 0)].sum() / npixels
+    return float(blank), float(cloud), float(suspect)
+
+def read_udm_mask(udm_file, flags=UDM_BLACKFILL | UDM_CLOUD):
+    # Boolean mask of UDM pixels with any of flags set, at full resolution
+    with rasterio.open(udm_file) as src:
+        return (src.read(1) & flags) != 0
+
+@timed('qa')
+def assess_scene_quality(tiff_file, udm_file=None, decimation=4, max_blank=0.25, max_cloud=0.25, max_suspect=0.25):
+    # Returns a QA record with the fraction of blank (blackfill), cloudy and
+    # suspect (missing or saturated band data) pixels and whether the scene
+    # passes. Without a UDM, blank and saturated pixels are found from a
+    # decimated read of the analytic bands and cloud is unknown (NaN)
+    if udm_file:
+        with rasterio.open(udm_file) as src:
+            codes = _read_decimated(src, [1], decimation)[0].astype(np.uint8)
+        source = 'udm'
+    else:
+        with rasterio.open(tiff_file) as src:
+            bands = _read_decimated(src, [1, 2, 3, 4], decimation)
+            saturated = np.iinfo(bands.dtype).max if bands.dtype.kind in 'ui' else np.inf
+        codes = np.where((bands == 0).all(axis=0), UDM_BLACKFILL, 0).astype(np.uint8)
+        codes |= np.where((bands >= saturated).any(axis=0), 4, 0).astype(np.uint8)
+        source = 'overview'
+
+    blank, cloud, suspect = _fractions(codes, codes.size)
+    if source == 'overview':
+        cloud = np.nan
+
+    passed = blank <= max_blank and suspect <= max_suspect and not cloud > max_cloud
+
+    return {
+        'source' : source,
+        'blank' : blank,
+        'cloud' : cloud,
+        'suspect' : suspect,
+        'passed' : passed
+    }
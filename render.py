@@ -0,0 +1,153 @@
+"""
+Fast NDVI and image rendering with a precomputed colormap lookup table,
+building images with Pillow instead of drawing through matplotlib. The
+colorbar is drawn with matplotlib once per process and pasted onto images
+"""
+
+import os
+import numpy as np
+
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
+
+VMIN = -0.25
+VMAX = 0.75
+MID = 0.1
+N_COLORS = 253 # colormap entries; the rest of the palette is for labels and NaN
+TEXT_INDEX = 253
+BACKGROUND_INDEX = 254
+NODATA_INDEX = 255
+TITLE_SIZE = 20 # px
+
+@lru_cache(maxsize=8)
+def ndvi_palette(cmap_name='RdYlGn'):
+    # N_COLORS colormap entries, black text and white background entries for
+    # frame labels and a transparent entry for NaN pixels, as (256, 3) RGB
+    # and (256,) alpha uint8 arrays
+    # matplotlib is only needed for the colormap, so it is imported here
+    import matplotlib.cm
+    cmap = getattr(matplotlib.cm, cmap_name)
+    rgb = np.round(cmap(np.linspace(0, 1, N_COLORS))[:, 0:3] * 255).astype(np.uint8)
+    palette = np.vstack([rgb, [[0, 0, 0], [255, 255, 255], [255, 255, 255]]]).astype(np.uint8)
+    alpha = np.full(256, 255, dtype=np.uint8)
+    alpha[NODATA_INDEX] = 0
+    return palette, alpha
+
+def ndvi_to_index(ndvi, vmin=VMIN, vmax=VMAX, mid=MID):
+    # Palette indices for NDVI values on the same midpoint-centred scale as
+    # MidpointNormalize, with NaN mapped to NODATA_INDEX. Both linear
+    # segments meet at mid, so each pixel only needs its segment's slope
+    ndvi = np.asarray(ndvi, dtype=np.float32)
+    half = (N_COLORS - 1) / 2.
+    slope = np.where(ndvi < mid, np.float32(half / (mid - vmin)), np.float32(half / (vmax - mid)))
+    index = np.clip((ndvi - np.float32(mid)) * slope + np.float32(half + 0.5), 0, N_COLORS - 0.5)
+    index[np.isnan(ndvi)] = NODATA_INDEX
+    return index.astype(np.uint8)
+
+def decimate(array, max_size):
+    # Nearest-neighbour overview whose longest side is at most max_size
+    if not max_size:
+        return array
+    step = int(np.ceil(max(array.shape[0:2]) / float(max_size)))
+    return array[::step, ::step] if step > 1 else array
+
+@lru_cache(maxsize=4)
+def title_font(size=TITLE_SIZE):
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+def title_height(size=TITLE_SIZE):
+    # Height of the band titles are drawn in, with a small margin
+    ascent, descent = title_font(size).getmetrics()
+    return ascent + descent + 2 * (size // 4)
+
+def title_width(text, size=TITLE_SIZE):
+    return int(np.ceil(title_font(size).getlength(text))) + 2 * (size // 4)
+
+def draw_title(image, text, fill, size=TITLE_SIZE):
+    # Draws text centred in the title band at the top of image. Glyphs are
+    # not antialiased on palette images, which have no colours to blend to
+    draw = ImageDraw.Draw(image)
+    if image.mode == 'P':
+        draw.fontmode = '1'
+    draw.text((image.width / 2., title_height(size) / 2.), text, fill=fill, font=title_font(size), anchor='mm')
+
+def ndvi_image(indices, cmap_name='RdYlGn'):
+    # Palette image of ndvi_to_index output, with NODATA_INDEX transparent
+    palette, alpha = ndvi_palette(cmap_name)
+    image = Image.fromarray(np.ascontiguousarray(indices, dtype=np.uint8), 'P')
+    image.putpalette(palette.tobytes())
+    image.info['transparency'] = NODATA_INDEX
+    return image
+
+def label_image(image, text, size=TITLE_SIZE):
+    # ndvi_image with text in a band above it, in the NDVI palette's label
+    # entries, e.g. for animation frames
+    top = title_height(size)
+    labelled = Image.new('P', (image.width, image.height + top), BACKGROUND_INDEX)
+    labelled.putpalette(image.getpalette())
+    labelled.info['transparency'] = NODATA_INDEX
+    labelled.paste(image, (0, top))
+    draw_title(labelled, text, TEXT_INDEX, size)
+    return labelled
+
+def compose_figure(image, title=None, colorbar=None):
+    # Stacks a title band, the image and an optional legend (see
+    # colorbar_strip) on a white background, like the matplotlib figures.
+    # The canvas is widened to fit the title and legend
+    image = image.convert('RGB')
+    width = max(image.width, colorbar.width if colorbar else 0, title_width(title) if title else 0)
+    top = title_height() if title else 0
+    figure = Image.new('RGB', (width, top + image.height + (colorbar.height if colorbar else 0)), 'white')
+    figure.paste(image, ((width - image.width) // 2, top))
+    if colorbar:
+        figure.paste(colorbar, ((width - colorbar.width) // 2, top + image.height))
+    if title:
+        draw_title(figure, title, 'black')
+    return figure
+
+def save_png(image, filename, title=None):
+    info = PngImagePlugin.PngInfo()
+    if title:
+        info.add_text('Title', title)
+    image.save(filename, 'PNG', pnginfo=info)
+    return filename
+
+def render_ndvi_png(ndvi, filename, title=None, max_size=1024, cmap_name='RdYlGn', colorbar=True):
+    # NaN pixels are left white, as on the matplotlib figure background
+    image = ndvi_image(ndvi_to_index(decimate(ndvi, max_size)), cmap_name)
+    legend = colorbar_strip(cmap_name=cmap_name) if colorbar else None
+    return save_png(compose_figure(image, title, legend), filename, title)
+
+def render_image_png(image, filename, title=None, max_size=1024):
+    # Reflectance RGB image, clipped to [0, 1] as imshow does for floats
+    rgb = np.nan_to_num(np.clip(decimate(image, max_size), 0, 1)) * 255 + 0.5
+    return save_png(compose_figure(Image.fromarray(rgb.astype(np.uint8), 'RGB'), title), filename, title)
+
+@lru_cache(maxsize=4)
+def colorbar_strip(label='NDVI', vmin=VMIN, vmax=VMAX, mid=MID, cmap_name='RdYlGn'):
+    # RGB colorbar legend, drawn once with matplotlib and pasted under every
+    # scene. TwoSlopeNorm is the same scale as MidpointNormalize
+    from matplotlib import cm
+    from matplotlib.colors import TwoSlopeNorm
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(4, 0.9), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.05, 0.6, 0.9, 0.3])
+    mappable = cm.ScalarMappable(norm=TwoSlopeNorm(mid, vmin=vmin, vmax=vmax), cmap=getattr(cm, cmap_name))
+    mappable.set_array(np.array([]))
+    cbar = fig.colorbar(mappable, cax=ax, orientation='horizontal')
+    cbar.set_label(label)
+    canvas.draw()
+
+    return Image.fromarray(np.array(canvas.buffer_rgba())[:, :, 0:3])
+
+def render_colorbar(filename, label='NDVI', vmin=VMIN, vmax=VMAX, mid=MID, cmap_name='RdYlGn'):
+    # Standalone copy of the legend drawn on each NDVI image
+    if os.path.exists(filename):
+        return filename
+    return save_png(colorbar_strip(label, vmin, vmax, mid, cmap_name), filename)
@@ -2,60 +2,206 @@
 Utilities for S3 data transfer
 """
 
+import os, hashlib, threading
 import boto
-from datetime import datetime, timedelta
-import numpy as np
-import pandas as pd
-
-def delete_file_from_s3(filename, bucket_name='usgs-mmh-ndvi'):
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
-    key = bucket.get_key(filename)
-    bucket.delete_key(key.name)
-
-def delete_old_keys_from_s3(max_age, bucket_name='usgs-mmh-ndvi', subdirectory='', bad_substring=''):
-    if subdirectory[-1] is not '/':
+
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.multipart import MultiPartUpload
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from instrument import count_bytes, timed
+from settings import S3_BUCKET_NAME
+
+MULTIPART_THRESHOLD = 16*1024*1024
+PART_SIZE = 8*1024*1024
+N_TRANSFERS = 8
+DELETE_BATCH_SIZE = 1000
+
+_connection_kwargs = {}
+_local = threading.local()
+
+def configure_s3(host=None, port=None, is_secure=True):
+    # Point every connection at another endpoint, e.g. a local S3 stand-in
+    # (threads reconnect on their next call)
+    _connection_kwargs.clear()
+    if host:
+        _connection_kwargs.update(host=host, port=port, is_secure=is_secure, calling_format=OrdinaryCallingFormat())
+
+def get_bucket(bucket_name=S3_BUCKET_NAME):
+    # boto connections are not thread-safe, so each thread keeps one
+    # connection (and its buckets) and reuses it for every call
+    kwargs = sorted(_connection_kwargs.items(), key=lambda kv: kv[0])
+    if getattr(_local, 'kwargs', None) != kwargs:
+        _local.connection = boto.connect_s3(**_connection_kwargs)
+        _local.buckets = {}
+        _local.kwargs = kwargs
+    if bucket_name not in _local.buckets:
+        _local.buckets[bucket_name] = _local.connection.get_bucket(bucket_name, validate=False)
+    return _local.buckets[bucket_name]
+
+def local_etag(filename, part_size=PART_SIZE):
+    # ETag S3 assigns to filename when uploaded by upload_file_to_s3: the
+    # MD5 for single-part uploads, the MD5 of part MD5s for multipart ones
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if size <= MULTIPART_THRESHOLD:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        digests = [hashlib.md5(chunk).digest() for chunk in iter(lambda: f.read(part_size), b'')]
+    return hashlib.md5(b''.join(digests)).hexdigest() + '-{:d}'.format(len(digests))
+
+def is_unchanged(filename, size, etag):
+    return os.path.exists(filename) and os.path.getsize(filename) == size and local_etag(filename) == etag.strip('"')
+
+def list_keys(prefix='', bucket_name=S3_BUCKET_NAME):
+    # Paginated listing scoped to prefix; yields boto keys lazily
+    for key in get_bucket(bucket_name).list(prefix=prefix):
+        yield key
+
+def delete_keys(key_names, bucket_name=S3_BUCKET_NAME):
+    # Multi-object deletes of up to 1000 keys per request
+    key_names = list(key_names)
+    bucket = get_bucket(bucket_name)
+    for i in range(0, len(key_names), DELETE_BATCH_SIZE):
+        bucket.delete_keys(key_names[i:i + DELETE_BATCH_SIZE], quiet=True)
+    return len(key_names)
+
+def _upload_part(bucket_name, key_name, upload_id, filename, part_num, offset, size):
+    mp = MultiPartUpload(get_bucket(bucket_name))
+    mp.key_name = key_name
+    mp.id = upload_id
+    with open(filename, 'rb') as fp:
+        fp.seek(offset)
+        mp.upload_part_from_file(fp, part_num, size=size)
+
+@timed('s3_upload')
+def upload_file_to_s3(filename, key_name, bucket_name=S3_BUCKET_NAME, policy=None, skip_unchanged=True, remote=None):
+    # Uploads filename unless the remote key has the same size and ETag
+    # (remote is an optional (size, etag) pair from an earlier listing).
+    # Large files are sent as concurrent multipart uploads
+    bucket = get_bucket(bucket_name)
+    size = os.path.getsize(filename)
+    if skip_unchanged:
+        if remote is None:
+            key = bucket.get_key(key_name)
+            remote = (key.size, key.etag) if key else None
+        if remote and is_unchanged(filename, *remote):
+            return False
+
+    count_bytes('s3_upload', size)
+    if size <= MULTIPART_THRESHOLD:
+        bucket.new_key(key_name).set_contents_from_filename(filename, policy=policy)
+        return True
+
+    mp = bucket.initiate_multipart_upload(key_name, policy=policy)
+    try:
+        with ThreadPoolExecutor(N_TRANSFERS) as pool:
+            futures = [pool.submit(_upload_part, bucket_name, key_name, mp.id, filename, i + 1, offset, min(PART_SIZE, size - offset))
+                       for i, offset in enumerate(range(0, size, PART_SIZE))]
+            for future in futures:
+                future.result()
+        mp.complete_upload()
+    except Exception:
+        mp.cancel_upload()
+        raise
+
+    return True
+
+def _download_range(bucket_name, key_name, filename, start, end):
+    key = get_bucket(bucket_name).new_key(key_name)
+    with open(filename, 'r+b') as fp:
+        fp.seek(start)
+        key.get_contents_to_file(fp, headers={'Range' : 'bytes={:d}-{:d}'.format(start, end)})
+
+@timed('s3_download')
+def download_file_from_s3(key_name, filename=None, bucket_name=S3_BUCKET_NAME, skip_unchanged=True):
+    # Large keys are fetched as concurrent ranged GETs into a preallocated file
+    filename = filename or key_name
+    key = get_bucket(bucket_name).get_key(key_name)
+    if skip_unchanged and is_unchanged(filename, key.size, key.etag):
+        return False
+
+    count_bytes('s3_download', key.size)
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    if key.size <= MULTIPART_THRESHOLD:
+        key.get_contents_to_filename(filename)
+        return True
+
+    tmp_filename = filename + '.part'
+    with open(tmp_filename, 'wb') as fp:
+        fp.truncate(key.size)
+    with ThreadPoolExecutor(N_TRANSFERS) as pool:
+        futures = [pool.submit(_download_range, bucket_name, key_name, tmp_filename, start, min(start + PART_SIZE, key.size) - 1)
+                   for start in range(0, key.size, PART_SIZE)]
+        for future in futures:
+            future.result()
+    os.replace(tmp_filename, filename)
+
+    return True
+
+def sync_dir_to_s3(local_dir, prefix, bucket_name=S3_BUCKET_NAME, policy=None, delete=False):
+    # Uploads new or changed files under local_dir to prefix concurrently,
+    # comparing against one paginated listing, and optionally batch-deletes
+    # remote keys with no local counterpart. Returns the uploaded key names
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    remote = {key.name : (key.size, key.etag) for key in list_keys(prefix, bucket_name)}
+
+    files = {}
+    for root, dirs, filenames in os.walk(local_dir):
+        for fn in filenames:
+            path = os.path.join(root, fn)
+            files[prefix + os.path.relpath(path, local_dir).replace(os.sep, '/')] = path
+
+    # Keys missing from the listing are passed as remote=False so uploads
+    # skip the per-key lookup
+    uploaded = []
+    with ThreadPoolExecutor(N_TRANSFERS) as pool:
+        futures = {pool.submit(upload_file_to_s3, path, key_name, bucket_name, policy, True, remote.get(key_name, False)) : key_name
+                   for key_name, path in files.items()}
+        for future, key_name in futures.items():
+            if future.result():
+                uploaded.append(key_name)
+
+    if delete:
+        delete_keys([k for k in remote if k not in files], bucket_name)
+
+    return sorted(uploaded)
+
+def delete_file_from_s3(filename, bucket_name=S3_BUCKET_NAME):
+    get_bucket(bucket_name).delete_key(filename)
+
+def delete_old_keys_from_s3(max_age, bucket_name=S3_BUCKET_NAME, subdirectory='', bad_substring=''):
+    if subdirectory and not subdirectory.endswith('/'):
         subdirectory += '/'
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
     today = datetime.now()
     date_format = '%Y-%m-%dT%H:%M:%S.%fZ'
-    for key in bucket.get_all_keys():
-        in_subdirectory = subdirectory in key.name and subdirectory is not key.name
+    old_keys = []
+    for key in list_keys(subdirectory, bucket_name):
         key_modified = datetime.strptime(key.last_modified, date_format)
         older_than_max_age = today - key_modified >= max_age
-        if in_subdirectory and older_than_max_age and bad_substring in key.name:
-            key.delete()
-
-def list_dir_s3(directory, bucket_name):
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
-    keys = bucket.get_all_keys()
-    filenames = [k.name for k in keys if directory in k.name]
-    filenames = filenames.remove(directory)
-    filenames = [fn.replace(directory, '') for fn in filenames]
+        if key.name != subdirectory and older_than_max_age and bad_substring in key.name:
+            old_keys.append(key.name)
+    return delete_keys(old_keys, bucket_name)
+
+def list_dir_s3(directory, bucket_name=S3_BUCKET_NAME):
+    filenames = [k.name.replace(directory, '', 1) for k in list_keys(directory, bucket_name) if k.name != directory]
     return filenames
 
-def download_data_from_s3(filename, bucket_name='usgs-mmh-ndvi'):
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
-    key = bucket.new_key(filename)
-    key.get_contents_to_filename(filename)
+def download_data_from_s3(filename, bucket_name=S3_BUCKET_NAME):
+    download_file_from_s3(filename, filename, bucket_name)
 
-def save_data_to_s3(data, filename=None, bucket_name='usgs-mmh-ndvi'):
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
+def save_data_to_s3(data, filename=None, bucket_name=S3_BUCKET_NAME):
     if not filename:
         d = datetime.now()
-        filename = 'tmp_' + d.isoformat() + '.pk'
-    key = bucket.new_key(filename)
-    data.to_pickle(filename)
-    key.set_contents_from_filename(filename)
-    key.set_canned_acl('public-read')
-
-def save_file_to_s3(infilename, outfilename, bucket_name='usgs-mmh-ndvi'):
-    connection = boto.connect_s3()
-    bucket = connection.get_bucket(bucket_name, validate=False)
-    key = bucket.new_key(outfilename)
-    key.set_contents_from_filename(infilename)
-    key.set_canned_acl('public-read')
+        filename = 'tmp_' + d.isoformat() + '.parquet'
+    data.to_parquet(filename)
+    upload_file_to_s3(filename, filename, bucket_name, policy='public-read', skip_unchanged=False)
+
+def save_file_to_s3(infilename, outfilename, bucket_name=S3_BUCKET_NAME):
+    upload_file_to_s3(infilename, outfilename, bucket_name, policy='public-read')
@@ -1,3 +1,13 @@
-PL_APY_KEY = '<api key>' # Planet API key
+import os
+
+PL_API_KEY = '<api key>' # Planet API key
 PL_AOIS = ['hsl'] # List of AOI names for json and directory structure
+PL_POOL_SIZE = 16 # Max pooled connections to the Planet APIs
 S3_BUCKET_NAME = 'usgs-mmh-ndvi'
+METADATA_INDEX = os.path.expanduser('~/.ndvi-monitoring/metadata.sqlite') # Parsed scene metadata cache
+SCENE_CATALOG = os.path.expanduser('~/.ndvi-monitoring/catalog.sqlite') # Planet search results per AOI
+JOB_QUEUE = os.path.expanduser('~/.ndvi-monitoring/jobs.sqlite') # Per-scene processing state
+N_WORKERS = 1 # Worker processes for timeseries computation
+JOB_WORKERS = 4 # Worker processes claiming scene jobs
+PROFILE_RUNS = False # Dump a cProfile .prof alongside each run report
+DATA_DIR = '/media/rmsare/GALLIUMOS/ndvi/' # Results root, one directory per AOI
@@ -0,0 +1,186 @@
+"""
+Single-pass NDVI scene statistics and rolling/seasonal aggregations over
+the stored NDVI timeseries
+"""
+
+import numpy as np
+import pandas as pd
+
+# Percentiles are read from a fine histogram accumulated alongside the
+# moments, so they are within half a bin (0.00025 NDVI) of the exact values
+FINE_BINS = 4000
+# Coarse histogram stored with each scene record
+HIST_EDGES = np.round(np.linspace(-1, 1, 41), 2)
+
+def _bin_index(values, bins):
+    index = ((np.clip(values, -1, 1) + 1) * (bins / 2.)).astype(np.int64)
+    np.minimum(index, bins - 1, out=index)
+    return index
+
+def histogram_percentiles(counts, q):
+    # Percentiles q of the values binned in counts (one fine histogram per
+    # row), interpolated within the bin holding each requested rank
+    counts = np.atleast_2d(counts)
+    bins = counts.shape[1]
+    cumulative = np.cumsum(counts, axis=1)
+    total = cumulative[:, -1:]
+    ranks = total * (np.asarray(q, dtype=np.float64) / 100.)[np.newaxis, :]
+    index = (cumulative[:, np.newaxis, :] < ranks[:, :, np.newaxis]).sum(axis=2)
+    index = np.minimum(index, bins - 1)
+    rows = np.arange(counts.shape[0])[:, np.newaxis]
+    below = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+    in_bin = counts[rows, index]
+    fraction = np.where(in_bin > 0, (ranks - below) / np.maximum(in_bin, 1), 0.5)
+    values = -1 + (index + np.clip(fraction, 0, 1)) * (2. / bins)
+    return np.where(total > 0, values, np.nan)
+
+class StreamingStats(object):
+    """
+    Mean and variance (Welford/Chan updates) and a histogram of NDVI values,
+    accumulated block by block so a scene is never held in memory at once.
+    NaN pixels are ignored
+    """
+    def __init__(self, bins=FINE_BINS):
+        self.bins = bins
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values):
+        values = values[np.isfinite(values)]
+        n = values.size
+        if n == 0:
+            return
+
+        # Block moments in float64, merged into the running ones
+        block_mean = values.mean(dtype=np.float64)
+        block_m2 = np.square(values - block_mean, dtype=np.float64).sum()
+        delta = block_mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += block_m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        self.counts += np.bincount(_bin_index(values, self.bins), minlength=self.bins)
+
+    @property
+    def sd(self):
+        # Population standard deviation, as numpy's std
+        return float(np.sqrt(self.m2 / self.count)) if self.count else np.nan
+
+    def percentiles(self, q):
+        return [float(v) for v in histogram_percentiles(self.counts, q)[0]]
+
+    def histogram(self, edges=HIST_EDGES):
+        # Counts re-binned onto coarser edges, which must fall on fine bin edges
+        index = np.round((np.asarray(edges) + 1) * (self.bins / 2.)).astype(np.int64)
+        return np.add.reduceat(self.counts, index[:-1])[0:len(edges) - 1] if self.count else np.zeros(len(edges) - 1, dtype=np.int64)
+
+    def record(self):
+        p10, p25, median, p75, p90 = self.percentiles([10, 25, 50, 75, 90])
+        return {
+            'm' : float(self.mean) if self.count else np.nan,
+            'sd' : self.sd,
+            'p10' : p10,
+            'p25' : p25,
+            'median' : median,
+            'p75' : p75,
+            'p90' : p90,
+            'count' : int(self.count),
+            'hist' : self.histogram().tolist()
+        }
+
+class ZonalStats(object):
+    """
+    Per-zone count, mean, sd and percentiles of NDVI for an integer label
+    raster (0 = no zone, 1..n_zones), accumulated block by block with one
+    bincount per statistic over all zones at once. Each block's per-zone
+    moments are merged into the running ones as in StreamingStats
+    """
+    def __init__(self, n_zones, bins=FINE_BINS):
+        self.n_zones = n_zones
+        self.bins = bins
+        self.count = np.zeros(n_zones + 1, dtype=np.int64)
+        self.mean = np.zeros(n_zones + 1, dtype=np.float64)
+        self.m2 = np.zeros(n_zones + 1, dtype=np.float64)
+        self.counts = np.zeros((n_zones + 1) * bins, dtype=np.int64)
+
+    def update(self, labels, values):
+        valid = np.isfinite(values) & (labels > 0)
+        labels = labels[valid]
+        values = values[valid].astype(np.float64)
+        if labels.size == 0:
+            return
+
+        size = self.n_zones + 1
+        n = np.bincount(labels, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_mean = np.bincount(labels, weights=values, minlength=size) / n
+        block_m2 = np.bincount(labels, weights=np.square(values - block_mean[labels]), minlength=size)
+
+        present = n > 0
+        delta = block_mean[present] - self.mean[present]
+        total = self.count[present] + n[present]
+        self.mean[present] += delta * n[present] / total
+        self.m2[present] += block_m2[present] + delta * delta * self.count[present] * n[present] / total
+        self.count += n
+        self.counts += np.bincount(labels * self.bins + _bin_index(values, self.bins), minlength=size * self.bins)
+
+    def records(self, names=None):
+        # One record per zone (named by names, else numbered from 1), in zone order
+        count = self.count[1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, self.mean[1:], np.nan)
+            sd = np.sqrt(self.m2[1:] / count)
+        percentiles = histogram_percentiles(self.counts.reshape(-1, self.bins)[1:], [10, 25, 50, 75, 90])
+        names = names or range(1, self.n_zones + 1)
+
+        return [{
+            'zone' : name,
+            'm' : float(mean[i]),
+            'sd' : float(sd[i]),
+            'p10' : float(percentiles[i, 0]),
+            'p25' : float(percentiles[i, 1]),
+            'median' : float(percentiles[i, 2]),
+            'p75' : float(percentiles[i, 3]),
+            'p90' : float(percentiles[i, 4]),
+            'count' : int(count[i])
+        } for i, name in enumerate(names)]
+
+def moving_median(data, window='30D', column='median', min_periods=1):
+    # Time-based rolling median over irregularly spaced acquisitions
+    return data[column].sort_index().rolling(window, min_periods=min_periods).median()
+
+def composites(data, freq='MS', column='median', how='median'):
+    # Per-period composites (monthly by default) of a per-scene statistic,
+    # with the number of scenes in each period
+    grouped = data[column].resample(freq)
+    result = pd.DataFrame({column : grouped.agg(how), 'n_scenes' : grouped.count()})
+    return result[result.n_scenes > 0]
+
+def _season(index, freq):
+    if freq == 'week':
+        return index.isocalendar().week.astype(int).values
+    return np.asarray(getattr(index, freq))
+
+def climatology(data, column='m', freq='month'):
+    # Mean, sd and number of scenes of a statistic per calendar month (or
+    # week/dayofyear) across all years in the series
+    grouped = data[column].groupby(_season(data.index, freq))
+    result = pd.DataFrame({'mean' : grouped.mean(), 'sd' : grouped.std(), 'count' : grouped.count()})
+    result.index.name = freq
+    return result
+
+def anomalies(data, column='m', freq='month', reference=None):
+    # Departure of each scene from the climatology of its month (or week),
+    # as a difference and a z-score. reference defaults to the climatology
+    # of data itself, e.g. pass climatology(store.read(end='2019')) for a
+    # fixed baseline
+    if reference is None:
+        reference = climatology(data, column, freq)
+    key = _season(data.index, freq)
+    expected = reference['mean'].reindex(key).values
+    spread = reference['sd'].reindex(key).values
+    anomaly = data[column].values - expected
+    return pd.DataFrame({'anomaly' : anomaly, 'zscore' : anomaly / spread}, index=data.index)
@@ -0,0 +1,14 @@
+import pytest
+
+import cli
+
+@pytest.mark.parametrize('command', sorted(cli.COMMAND_MODULES))
+def test_heavy_imports(command):
+    # Each subcommand's modules import cleanly in a fresh interpreter without
+    # pulling in heavy packages it has no use for at import time
+    loaded = cli.loaded_packages(cli.COMMAND_MODULES[command])
+    unexpected = set(cli.HEAVY_MODULES) & loaded - set(cli.COMMAND_HEAVY_MODULES[command])
+    assert not unexpected, "importing {} loads {}".format(command, ', '.join(sorted(unexpected)))
+
+def test_cli_is_light():
+    assert not set(cli.HEAVY_MODULES + ['numpy', 'requests']) & cli.loaded_packages(['cli'])
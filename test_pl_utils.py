@@ -0,0 +1,147 @@
+import io, json, os, threading, time, zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from jobs import JobQueue, run_scene_jobs, DOWNLOADED
+from pl_utils import CLIP_MEMBERS, extract_members
+
+AOI_POLYGON = {'type' : 'Polygon', 'coordinates' : [[[-120.0, 38.0], [-119.9, 38.0], [-119.9, 38.1], [-120.0, 38.0]]]}
+STALLED = '20200601_180000_0000'
+
+def clip_zip(scene_id):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipped:
+        for member in CLIP_MEMBERS + ['manifest.json']:
+            zipped.writestr(scene_id + '/' + scene_id + '_' + member, scene_id + member)
+    return buffer.getvalue()
+
+class ClipsHandler(BaseHTTPRequestHandler):
+    # Stand-in for the clips API: jobs are queued for a couple of polls,
+    # then succeed with a link to a zip of the clipped files, except the
+    # STALLED scene's, which never finish
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        scene_id = payload['targets'][0]['item_id']
+        with server.lock:
+            server.submitted.append(scene_id)
+            job_id = 'job_{:04d}_{}'.format(len(server.submitted), scene_id)
+            server.polls[job_id] = 0
+        self.send_json({'_links' : {'_self' : server.url + '/clips/' + job_id}})
+
+    def do_GET(self):
+        server = self.server
+        kind, name = self.path.strip('/').split('/')
+        if kind == 'clips':
+            with server.lock:
+                server.polls[name] += 1
+                polls = server.polls[name]
+            scene_id = name.split('_', 2)[2]
+            if scene_id == STALLED or polls < 3:
+                self.send_json({'state' : 'running' if polls > 1 else 'queued'})
+            else:
+                self.send_json({'state' : 'succeeded', '_links' : {'results' : [server.url + '/files/' + scene_id + '.zip']}})
+            return
+
+        with server.lock:
+            server.downloading += 1
+            server.max_downloading = max(server.max_downloading, server.downloading)
+        try:
+            time.sleep(0.2)
+            data = clip_zip(name[:-4])
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with server.lock:
+                server.downloading -= 1
+
+@pytest.fixture
+def clips_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ClipsHandler)
+    server.url = 'http://127.0.0.1:{:d}'.format(server.server_address[1])
+    server.lock = threading.Lock()
+    server.submitted = []
+    server.polls = {}
+    server.downloading = 0
+    server.max_downloading = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def scene_features(scene_ids):
+    return [{'id' : s, 'properties' : {'acquired' : s[0:8]}} for s in scene_ids]
+
+def download_scenes(tmpdir, server, scene_ids, n_workers, **options):
+    results_dir = str(tmpdir) + '/'
+    os.mkdir(results_dir + 'data/')
+    queue = JobQueue(results_dir + 'jobs.sqlite', max_attempts=2, backoff=0)
+    queue.enqueue('aoi', scene_features(scene_ids))
+    counts = run_scene_jobs(queue, 'aoi', AOI_POLYGON, results_dir, n_workers, process=False,
+                            poll_interval=0.05, clips_url=server.url + '/clips', **options)
+    return results_dir, queue, counts
+
+def test_clip_jobs_download(tmpdir, clips_server):
+    # Each scene is clipped once, polled until its job succeeds and its
+    # clip members are extracted into data/<scene_id>
+    scene_ids = ['20200601_180000_{:04d}'.format(i) for i in range(1, 7)]
+    results_dir, queue, counts = download_scenes(tmpdir, clips_server, scene_ids, n_workers=2)
+
+    assert counts[DOWNLOADED] == len(scene_ids)
+    assert sorted(clips_server.submitted) == scene_ids
+    assert all(n >= 3 for n in clips_server.polls.values())
+    for scene_id in scene_ids:
+        assert sorted(os.listdir(results_dir + 'data/' + scene_id)) == sorted([scene_id + '_' + m for m in CLIP_MEMBERS])
+    assert sorted(os.listdir(results_dir + 'data/')) == scene_ids
+
+def test_download_concurrency(tmpdir, clips_server):
+    # Downloads run in the worker processes, at most one per worker
+    scene_ids = ['20200601_180000_{:04d}'.format(i) for i in range(1, 9)]
+    results_dir, queue, counts = download_scenes(tmpdir, clips_server, scene_ids, n_workers=3)
+
+    assert counts[DOWNLOADED] == len(scene_ids)
+    assert 1 <= clips_server.max_downloading <= 3
+
+def test_clip_timeout(tmpdir, clips_server):
+    # A clip job that never finishes is resubmitted after clip_timeout, and
+    # the scene fails for good once it runs out of attempts
+    results_dir, queue, counts = download_scenes(tmpdir, clips_server, [STALLED, '20200601_180000_0001'], n_workers=1, clip_timeout=2)
+
+    assert counts[DOWNLOADED] == 1
+    assert counts['failed'] == 1
+    assert clips_server.submitted.count(STALLED) == 2
+    [job] = queue.failed_jobs('aoi')
+    assert job['scene_id'] == STALLED and 'timed out' in job['error']
+    assert not os.path.exists(results_dir + 'data/' + STALLED)
+
+def test_extract_members_replaces_existing_dir(tmpdir):
+    # Re-extracting a scene replaces its directory, dropping stale files
+    scene_id = '20200601_180000_0001'
+    zip_filename = str(tmpdir.join(scene_id + '.zip'))
+    with open(zip_filename, 'wb') as f:
+        f.write(clip_zip(scene_id))
+    out_dir = str(tmpdir.join(scene_id))
+    os.mkdir(out_dir)
+    with open(os.path.join(out_dir, 'stale.tif'), 'w') as f:
+        f.write('stale')
+
+    for i in range(2):
+        assert extract_members(zip_filename, out_dir, CLIP_MEMBERS) == out_dir
+        assert sorted(os.listdir(out_dir)) == sorted([scene_id + '_' + m for m in CLIP_MEMBERS])
+    assert sorted(os.listdir(str(tmpdir))) == [scene_id, scene_id + '.zip']
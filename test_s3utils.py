@@ -0,0 +1,104 @@
+import os
+
+import boto
+import pytest
+import requests
+
+from boto.s3.bucket import Bucket
+from moto.server import ThreadedMotoServer
+
+import s3utils
+
+BUCKET = 'ndvi-test'
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # A moto S3 server on localhost, with multipart transfers kicking in
+    # above 1 MB so a 10 MB file goes up and down in two 8 MB parts
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(s3utils, 'MULTIPART_THRESHOLD', 1024*1024)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    s3utils.configure_s3(host, port, is_secure=False)
+    boto.connect_s3(**s3utils._connection_kwargs).create_bucket(BUCKET)
+    yield s3utils.get_bucket(BUCKET)
+    s3utils.configure_s3()
+    # Moto keeps its buckets in process-wide state across servers
+    requests.post('http://{}:{:d}/moto-api/reset'.format(host, port))
+    server.stop()
+
+def write_file(filename, size, seed=0):
+    # A repeating pattern that differs between seeds
+    pattern = bytes([(i * 7 + seed) % 251 for i in range(251)])
+    with open(filename, 'wb') as f:
+        f.write((pattern * (size // 251 + 1))[:size])
+    return filename
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_multipart_upload(tmpdir, bucket):
+    # Large files are sent as multipart uploads whose ETag matches local_etag
+    filename = write_file(str(tmpdir.join('big.tif')), 10*1024*1024)
+    assert s3utils.upload_file_to_s3(filename, 'aoi/big.tif', BUCKET)
+
+    key = bucket.get_key('aoi/big.tif')
+    assert key.size == os.path.getsize(filename)
+    assert key.etag.strip('"') == s3utils.local_etag(filename)
+    assert key.etag.strip('"').endswith('-2')
+
+def test_skip_unchanged(tmpdir, bucket):
+    # Files matching the remote size and ETag are neither uploaded nor
+    # downloaded again
+    small = write_file(str(tmpdir.join('small.png')), 1000)
+    big = write_file(str(tmpdir.join('big.tif')), 10*1024*1024)
+    for filename in [small, big]:
+        key_name = 'aoi/' + os.path.basename(filename)
+        assert s3utils.upload_file_to_s3(filename, key_name, BUCKET)
+        assert not s3utils.upload_file_to_s3(filename, key_name, BUCKET)
+        assert not s3utils.download_file_from_s3(key_name, filename, BUCKET)
+
+    write_file(small, 1000, seed=1)
+    assert s3utils.upload_file_to_s3(small, 'aoi/small.png', BUCKET)
+    assert s3utils.sync_dir_to_s3(str(tmpdir), 'aoi', BUCKET) == []
+
+def test_ranged_download(tmpdir, bucket, monkeypatch):
+    # Large keys come down as concurrent ranged GETs, one per part
+    filename = write_file(str(tmpdir.join('big.tif')), 10*1024*1024 + 123)
+    s3utils.upload_file_to_s3(filename, 'aoi/big.tif', BUCKET)
+
+    ranges = []
+    download_range = s3utils._download_range
+    def record_range(bucket_name, key_name, filename, start, end):
+        ranges.append((start, end))
+        download_range(bucket_name, key_name, filename, start, end)
+    monkeypatch.setattr(s3utils, '_download_range', record_range)
+
+    out_filename = str(tmpdir.join('out', 'big.tif'))
+    assert s3utils.download_file_from_s3('aoi/big.tif', out_filename, BUCKET)
+    assert read_file(out_filename) == read_file(filename)
+    assert sorted(ranges) == [(0, s3utils.PART_SIZE - 1), (s3utils.PART_SIZE, os.path.getsize(filename) - 1)]
+    assert not os.path.exists(out_filename + '.part')
+
+def test_batched_deletes(tmpdir, bucket, monkeypatch):
+    # Remote keys with no local file are removed in batches of
+    # DELETE_BATCH_SIZE by sync_dir_to_s3(delete=True)
+    monkeypatch.setattr(s3utils, 'DELETE_BATCH_SIZE', 2)
+    batches = []
+    delete_keys = Bucket.delete_keys
+    def record_batch(self, keys, *args, **kwargs):
+        batches.append(list(keys))
+        return delete_keys(self, keys, *args, **kwargs)
+    monkeypatch.setattr(Bucket, 'delete_keys', record_batch)
+
+    for i in range(5):
+        bucket.new_key('aoi/img/old_{:d}.png'.format(i)).set_contents_from_string('old')
+    local_dir = tmpdir.mkdir('img')
+    write_file(str(local_dir.join('new.png')), 100)
+
+    assert s3utils.sync_dir_to_s3(str(local_dir), 'aoi/img', BUCKET, delete=True) == ['aoi/img/new.png']
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert [k.name for k in s3utils.list_keys('aoi/', BUCKET)] == ['aoi/img/new.png']
@@ -0,0 +1,137 @@
+"""
+Append-only NDVI timeseries store, partitioned by year as Parquet files
+"""
+
+import os, glob, time, uuid, fcntl
+import pandas as pd
+
+from contextlib import contextmanager
+
+COLUMNS = ['scene', 'm', 'sd', 'p10', 'p25', 'median', 'p75', 'p90', 'count', 'hist']
+MAX_PARTS = 8 # per year before an incremental update compacts it
+READ_RETRIES = 5
+
+def end_of_period(end):
+    # Last instant covered by end
+    if isinstance(end, str):
+        return pd.Period(end).end_time
+    end = pd.Timestamp(end)
+    if end == end.normalize():
+        return end + pd.Timedelta(days=1) - pd.Timedelta(1, unit='ns')
+    return end
+
+class TimeseriesStore(object):
+    """
+    One row per scene, indexed by acquisition datetime. Every append writes
+    new immutable part files (renamed into place), so readers never see a
+    partially written file and never block writers. Rows for the same
+    datetime in later parts replace earlier ones when read
+    """
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _partition(self, year):
+        return os.path.join(self.root, 'year={:d}'.format(year))
+
+    def _parts(self, year=None):
+        pattern = 'year=*' if year is None else 'year={:d}'.format(year)
+        # Part names start with a nanosecond timestamp, so name order is write order
+        return sorted(glob.glob(os.path.join(self.root, pattern, 'part-*.parquet')), key=os.path.basename)
+
+    def _years(self):
+        return sorted([int(d.split('=')[1]) for d in os.listdir(self.root) if d.startswith('year=')])
+
+    def _write_part(self, data, year, stamp=None):
+        partition = self._partition(year)
+        if not os.path.exists(partition):
+            os.makedirs(partition, exist_ok=True)
+        name = 'part-{:d}-{}.parquet'.format(stamp or time.time_ns(), uuid.uuid4().hex[0:8])
+        tmp_filename = os.path.join(partition, '.' + name)
+        data.to_parquet(tmp_filename)
+        os.replace(tmp_filename, os.path.join(partition, name))
+
+    def append(self, data):
+        if data.empty:
+            return
+        data = data.reindex(columns=COLUMNS)
+        data.index = pd.DatetimeIndex(data.index, name='date')
+        for year, rows in data.groupby(data.index.year):
+            self._write_part(rows.sort_index(), year)
+
+    def read(self, start=None, end=None):
+        # end is inclusive of the whole period it names: a date or midnight
+        # datetime covers that day, and a string such as '2019' or '2019-06'
+        # its whole year or month, as in pandas' partial string indexing
+        start = pd.Timestamp(start) if start is not None else None
+        end = end_of_period(end) if end is not None else None
+
+        # A compaction may remove parts after they are listed; its compacted
+        # part is in place by then, so listing again picks it up
+        for attempt in range(READ_RETRIES):
+            try:
+                data = self._read_parts(start, end)
+                break
+            except FileNotFoundError:
+                if attempt == READ_RETRIES - 1:
+                    raise
+        if data is None:
+            return pd.DataFrame(columns=COLUMNS, index=pd.DatetimeIndex([], name='date'))
+
+        return data.loc[start:end]
+
+    def _read_parts(self, start, end):
+        # Prune partitions outside the requested years before reading anything
+        parts = []
+        for year in self._years():
+            if (start is None or year >= start.year) and (end is None or year <= end.year):
+                parts += self._parts(year)
+        if not parts:
+            return None
+
+        data = pd.concat([pd.read_parquet(p) for p in parts])
+        return data[~data.index.duplicated(keep='last')].sort_index()
+
+    @contextmanager
+    def lock(self):
+        # Exclusive lock on the store, held by compactions in any process
+        with open(os.path.join(self.root, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def compact(self, max_parts=1):
+        # Rewrites each year with more than max_parts parts as a single part.
+        # Old parts are removed only after the compacted one is in place (see
+        # read). The compacted part takes the newest old part's timestamp, so
+        # it still sorts before parts appended while it was being written.
+        # Compactions take the store's lock, so two of them never merge the
+        # same parts; parts another process removed anyway are skipped
+        with self.lock():
+            for year in self._years():
+                parts = self._parts(year)
+                if len(parts) <= max_parts:
+                    continue
+                frames = []
+                for p in parts:
+                    try:
+                        frames.append(pd.read_parquet(p))
+                    except FileNotFoundError:
+                        continue
+                if not frames:
+                    continue
+                data = pd.concat(frames)
+                data = data[~data.index.duplicated(keep='last')].sort_index()
+                self._write_part(data, year, stamp=int(os.path.basename(parts[-1]).split('-')[1]))
+                for p in parts:
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+
+    def import_pickle(self, filename):
+        # One-off migration of a legacy timeseries.pk
+        self.append(pd.read_pickle(filename))
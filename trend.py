@@ -0,0 +1,156 @@
+"""
+Per-pixel harmonic trend models and changepoints for an AOI's NDVI datacube.
+Every pixel of a tile is fit at once with batched least squares over the
+(time, pixel) matrix, and tiles are spread across worker processes
+"""
+
+import os, uuid
+import numpy as np
+import rasterio
+
+from datetime import datetime
+from multiprocessing import Pool
+
+from settings import N_WORKERS
+from datacube import NDVICube, unscale_ndvi
+from instrument import timed
+
+N_HARMONICS = 2
+MIN_OBS = 12
+CUSUM_CRITICAL = 1.358 # sup of a Brownian bridge, 5% level
+
+PRODUCTS = ['trend', 'amplitude', 'rmse', 'n_obs', 'cusum', 'break_date', 'break_magnitude']
+
+def decimal_years(times):
+    return np.array([t.year + (t - datetime(t.year, 1, 1)).total_seconds() / (datetime(t.year + 1, 1, 1) - datetime(t.year, 1, 1)).total_seconds()
+                     for t in times])
+
+def design_matrix(t, n_harmonics=N_HARMONICS, t0=None):
+    # (time, 2 + 2*n_harmonics) columns: intercept, linear trend in years
+    # from t0, then a cosine and sine per harmonic of the annual cycle
+    t0 = t[0] if t0 is None else t0
+    columns = [np.ones_like(t), t - t0]
+    for k in range(1, n_harmonics + 1):
+        columns += [np.cos(2 * np.pi * k * t), np.sin(2 * np.pi * k * t)]
+    return np.stack(columns, axis=1)
+
+def fit_harmonic(X, Y, min_obs=MIN_OBS):
+    # Least squares fit of X to every column of Y (time, pixel), skipping
+    # NaNs. The normal equations of all pixels are formed with two matrix
+    # products and solved as one stacked pseudo-inverse. Returns
+    # coefficients (pixel, k), residuals (time, pixel, NaN where missing),
+    # residual sd and observation counts; pixels with fewer than min_obs
+    # observations get NaN coefficients
+    n_times, k = X.shape
+    valid = ~np.isnan(Y)
+    observed = valid.astype(X.dtype)
+    n = valid.sum(axis=0)
+
+    outer = (X[:, :, np.newaxis] * X[:, np.newaxis, :]).reshape(n_times, k * k)
+    XtX = (outer.T @ observed).T.reshape(-1, k, k)
+    Xty = (X.T @ np.where(valid, Y, 0)).T
+
+    fitted = n >= max(min_obs, k + 1)
+    beta = np.full((Y.shape[1], k), np.nan)
+    beta[fitted] = (np.linalg.pinv(XtX[fitted]) @ Xty[fitted, :, np.newaxis])[:, :, 0]
+
+    residuals = Y - X @ beta.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(np.nansum(residuals**2, axis=0) / (n - k))
+    sd[~fitted] = np.nan
+    return beta, residuals, sd, n
+
+def cusum_breaks(t, residuals, sd, n):
+    # OLS-CUSUM test per pixel: the largest excursion of the scaled
+    # cumulative residuals marks the most likely break. Returns the
+    # statistic, break date (NaN unless above CUSUM_CRITICAL) and the mean
+    # residual shift across the break
+    valid = ~np.isnan(residuals)
+    cumulative = np.cumsum(np.where(valid, residuals, 0), axis=0)
+    count = np.cumsum(valid, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        process = np.abs(cumulative) / (sd * np.sqrt(n))
+        process[np.isnan(process)] = 0
+        index = np.argmax(process, axis=0)
+        pixels = np.arange(residuals.shape[1])
+        statistic = process[index, pixels]
+
+        before_sum, before_n = cumulative[index, pixels], count[index, pixels]
+        after_sum, after_n = cumulative[-1] - before_sum, n - before_n
+        magnitude = after_sum / after_n - before_sum / before_n
+
+    statistic[np.isnan(sd)] = np.nan
+    significant = statistic > CUSUM_CRITICAL
+    break_date = np.where(significant, t[index], np.nan)
+    magnitude = np.where(significant, magnitude, np.nan)
+    return statistic, break_date, magnitude
+
+def analyze_pixels(t, Y, n_harmonics=N_HARMONICS, min_obs=MIN_OBS):
+    # Every product for the pixels in the columns of Y (time, pixel)
+    X = design_matrix(t, n_harmonics)
+    beta, residuals, sd, n = fit_harmonic(X, Y, min_obs)
+    statistic, break_date, magnitude = cusum_breaks(t, residuals, sd, n)
+    return {
+        'trend' : beta[:, 1],
+        'amplitude' : np.hypot(beta[:, 2], beta[:, 3]),
+        'rmse' : sd,
+        'n_obs' : n,
+        'cusum' : statistic,
+        'break_date' : break_date,
+        'break_magnitude' : magnitude
+    }
+
+def analyze_tile(args):
+    cube_root, filename, row, col, shape, order, t, n_harmonics, min_obs = args
+    cube = NDVICube(cube_root)
+    tile = cube.tile_array(filename, shape)
+    Y = unscale_ndvi(tile[order]).reshape(len(order), -1).astype(np.float64)
+    return row, col, shape, analyze_pixels(t, Y, n_harmonics, min_obs)
+
+def write_product(filename, data, cube):
+    profile = dict(driver='GTiff', count=1, height=cube.height, width=cube.width, crs=cube.crs, transform=cube.transform,
+                   dtype=rasterio.float32, nodata=np.nan, tiled=True, blockxsize=256, blockysize=256,
+                   compress='deflate', predictor=3)
+    tmp_filename = '{}.{}.tmp'.format(filename, uuid.uuid4().hex[0:8])
+    with rasterio.open(tmp_filename, 'w', **profile) as dst:
+        dst.write(data.astype(np.float32), 1)
+    os.replace(tmp_filename, filename)
+
+@timed('trend')
+def analyze_cube(cube_root, out_dir, n_harmonics=N_HARMONICS, min_obs=MIN_OBS, start=None, end=None, n_workers=N_WORKERS):
+    # Fits the harmonic model to every pixel's history in cube_root (e.g.
+    # the daily mosaic, so split scenes count once) between start and end,
+    # and writes one float32 GeoTIFF per product to out_dir: trend in NDVI
+    # per year, annual amplitude, residual sd, observations, CUSUM
+    # statistic, break date in decimal years and break magnitude
+    cube = NDVICube(cube_root)
+    times = cube.times
+    order = [i for i in np.argsort(times, kind='stable') if (start is None or times[i] >= start) and (end is None or times[i] <= end)]
+    if len(order) < min_obs:
+        print("Too few frames to fit a trend in " + cube_root)
+        return None
+    t = decimal_years([times[i] for i in order])
+
+    products = {p : np.full((cube.height, cube.width), np.nan, dtype=np.float32) for p in PRODUCTS}
+    tasks = [(cube_root, filename, row, col, shape, order, t, n_harmonics, min_obs) for filename, row, col, shape in cube.tiles()]
+
+    pool = Pool(n_workers) if n_workers > 1 else None
+    try:
+        results = pool.imap_unordered(analyze_tile, tasks) if pool else map(analyze_tile, tasks)
+        for row, col, shape, result in results:
+            for p in PRODUCTS:
+                products[p][row:row + shape[0], col:col + shape[1]] = result[p].reshape(shape)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    filenames = {}
+    for p in PRODUCTS:
+        filenames[p] = os.path.join(out_dir, p + '.tif')
+        write_product(filenames[p], products[p], cube)
+
+    return filenames
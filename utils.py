@@ -3,15 +3,23 @@ import numpy as np
 import matplotlib.colors as colors
 from scipy.io import loadmat
 import json
-from xml.dom import minidom
 import rasterio
 import subprocess
 
-from osgeo import ogr, osr
+from functools import lru_cache
+from rasterio.features import geometry_mask, rasterize
+from rasterio.windows import Window
+
+# GDAL's Python bindings are imported by the shapefile and AOI conversion
+# functions that use them, so loading scenes does not require them
 from geojson import Polygon
 
 from datetime import datetime
 
+from instrument import timed
+from metadata import get_reflectance_coefficients
+
+@timed('clip_to_shape')
 def clip_tiff_by_shapefile(tiff_file, shapefile):
     out_file = tiff_file[:-4] + '_clip.tif'
     
@@ -24,7 +32,100 @@ def clip_tiff_by_shapefile(tiff_file, shapefile):
 
     return out_file
 
+@lru_cache(maxsize=16)
+def _read_shapefile_geometries(shapefile, mtime, crs_wkt, field=None):
+    from osgeo import ogr, osr
+    target = osr.SpatialReference()
+    target.ImportFromWkt(crs_wkt)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    datasource = ogr.Open(shapefile)
+    layer = datasource.GetLayer()
+    source = layer.GetSpatialRef()
+    transform = None
+    if source is not None:
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(source, target)
+
+    geometries = []
+    names = []
+    xmin = ymin = np.inf
+    xmax = ymax = -np.inf
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        gxmin, gxmax, gymin, gymax = geometry.GetEnvelope()
+        xmin, xmax = min(xmin, gxmin), max(xmax, gxmax)
+        ymin, ymax = min(ymin, gymin), max(ymax, gymax)
+        geometries.append(json.loads(geometry.ExportToJson()))
+        names.append(feature.GetField(field) if field else feature.GetFID())
+
+    return geometries, (xmin, ymin, xmax, ymax), names
+
+def read_shapefile_geometries(shapefile, crs_wkt, field=None):
+    # Geometries reprojected to the raster CRS, their combined bounds, and
+    # the name of each feature (its field value, or FID)
+    return _read_shapefile_geometries(os.path.abspath(shapefile), os.path.getmtime(shapefile), crs_wkt, field)
+
+def _bounds_window(bounds, transform, width, height, shapefile):
+    # Pixel bounding box of bounds, snapped outwards and clamped to the grid
+    cols, rows = (~transform) * (np.array(bounds[0::2]), np.array(bounds[1::2]))
+    col_off = max(int(np.floor(cols.min())), 0)
+    row_off = max(int(np.floor(rows.min())), 0)
+    col_end = min(int(np.ceil(cols.max())), width)
+    row_end = min(int(np.ceil(rows.max())), height)
+    if col_end <= col_off or row_end <= row_off:
+        raise ValueError(shapefile + " does not intersect raster grid")
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+@lru_cache(maxsize=32)
+def _shapefile_window_and_mask(shapefile, mtime, crs_wkt, transform, width, height):
+    geometries, bounds, names = _read_shapefile_geometries(shapefile, mtime, crs_wkt)
+    transform = rasterio.Affine(*transform)
+
+    window = _bounds_window(bounds, transform, width, height, shapefile)
+    window_transform = rasterio.windows.transform(window, transform)
+    outside = geometry_mask(geometries, out_shape=(int(window.height), int(window.width)), transform=window_transform)
+    outside.setflags(write=False)
+
+    return window, outside
+
+@lru_cache(maxsize=32)
+def _shapefile_zone_labels(shapefile, mtime, crs_wkt, transform, width, height, field):
+    geometries, bounds, names = _read_shapefile_geometries(shapefile, mtime, crs_wkt, field)
+    transform = rasterio.Affine(*transform)
+
+    window = _bounds_window(bounds, transform, width, height, shapefile)
+    window_transform = rasterio.windows.transform(window, transform)
+    # Where features overlap, the later one wins
+    labels = rasterize([(g, i + 1) for i, g in enumerate(geometries)], out_shape=(int(window.height), int(window.width)),
+                       transform=window_transform, fill=0, dtype=np.int32)
+    labels.setflags(write=False)
+
+    return window, labels, tuple(names)
+
+@timed('clip_to_shape')
+def get_shapefile_window_and_mask(src, shapefile):
+    # Bounding window of the shapefile polygons in src and a boolean mask
+    # over that window (True outside the polygons). Masks are cached per
+    # shapefile and grid, so scenes sharing a grid rasterize only once
+    return _shapefile_window_and_mask(os.path.abspath(shapefile), os.path.getmtime(shapefile), src.crs.to_wkt(),
+                                      tuple(src.transform)[0:6], src.width, src.height)
+
+@timed('clip_to_shape')
+def get_shapefile_zones(src, shapefile, field=None):
+    # Bounding window of the shapefile features in src, an int32 label
+    # raster over it (0 outside all features, i + 1 inside feature i) and
+    # the feature names. Cached per shapefile and grid like the masks
+    return _shapefile_zone_labels(os.path.abspath(shapefile), os.path.getmtime(shapefile), src.crs.to_wkt(),
+                                  tuple(src.transform)[0:6], src.width, src.height, field)
+
 def convert_mat_to_json(filename, outfilename, source_epsg=32611, target_epsg=4326):
+    from osgeo import ogr, osr
     mat = loadmat(filename)
     X = mat['xb'][0]
     Y = mat['yb'][0]
@@ -53,6 +154,7 @@ def convert_mat_to_json(filename, outfilename, source_epsg=32611, target_epsg=43
         json.dump(aoi, f)
 
 def convert_mat_to_aoi_bbox(filename, buf=1000, source_epsg=32611, target_epsg=4326):
+    from osgeo import ogr, osr
     mat = loadmat(filename)
     x = mat['xb']
     y = mat['yb']
@@ -86,6 +188,7 @@ def convert_mat_to_aoi_bbox(filename, buf=1000, source_epsg=32611, target_epsg=4
 
     return aoi
 
+@timed('load')
 def load_image(filename, metadata_filename):
     with rasterio.open(filename) as src:
         band_blue = src.read(1)
@@ -96,16 +199,7 @@ def load_image(filename, metadata_filename):
     with rasterio.open(filename) as src:
         band_red = src.read(3)
 
-    xmldoc = minidom.parse(metadata_filename)
-    nodes = xmldoc.getElementsByTagName("ps:bandSpecificMetadata")
-
-    coeff = {}
-    for node in nodes:
-        band_num = node.getElementsByTagName("ps:bandNumber")[0].firstChild.data
-        if band_num in ['1', '2', '3', '4']:
-            i = int(band_num)
-            value = node.getElementsByTagName("ps:reflectanceCoefficient")[0].firstChild.data
-            coeff[i] = float(value)
+    coeff = get_reflectance_coefficients(metadata_filename)
 
     band_blue = band_blue*coeff[1]
     band_green = band_green*coeff[2]
@@ -116,12 +210,6 @@ def load_image(filename, metadata_filename):
 def print_json(data):
     print(json.dumps(data, indent=2))
 
-def rfc3339(date_obj):
-    # XXX: Assumes date_obj is UTC +0
-    # TODO : TZ conversion
-    rfc_fmt = '%Y-%m-%dT%H:%M:%SZ'
-    return datetime.strftime(date_obj, rfc_fmt)
-
 
 class MidpointNormalize(colors.Normalize):
     """